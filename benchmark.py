@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import yaml
+
+# Offline benchmark for the command pipeline. bliss.py is imported inside a
+# scratch directory with a generated config.yml, its upstream calls go to an
+# in-process stand-in for the updater and GitHub, and its handlers are driven
+# with fake hydrogram Client/Message objects.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_CONFIG = {
+    "telegram": {
+        "api_id": 1,
+        "api_hash": "benchmark",
+        "bot_token": "1:benchmark",
+        "authorized_ids": [1],
+        "group_ids": [None],
+        # Outbound and per-user limits would otherwise measure the sleeps
+        "chat_rate": 1000000,
+        "chat_burst": 1000000,
+        "global_rate": 1000000,
+        "global_burst": 1000000,
+        "user_command_rate": 1000000,
+        "user_command_burst": 1000000,
+        "announce_builds": False,
+    },
+    "bliss": {
+        "download_url":
+        "https://downloads.blissroms.org/api/v1/updater/los/{0}/{1}/",
+        "user_agent": None,
+        "default_user_agent": "BlissBot-Benchmark",
+        "state_db": "bliss_state.db",
+    },
+}
+BOT_USER = SimpleNamespace(id=1000, is_bot=True, username="blissrom_bot")
+
+
+def get_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=REPO_DIR,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def make_devices(count: int) -> List[Dict]:
+    brands = ["Asus", "Google", "OnePlus", "Samsung", "Xiaomi", "Motorola"]
+    return [{
+        "codename":
+        f"device{index:04d}",
+        "brand":
+        brands[index % len(brands)],
+        "name":
+        f"Model {index}",
+        "supported_versions": [{
+            "maintainer_name":
+            f"Maintainer {index}",
+            "support_thread":
+            f"https://t.me/device{index:04d}",
+        }],
+    } for index in range(count)]
+
+
+# Upstream stand-in
+class Upstream:
+
+    def __init__(self, devices: List[Dict], latency: float, jitter: float,
+                 error_rate: float) -> None:
+        self.devices_content = json.dumps(devices).encode()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests: Counter = Counter()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.rstrip("/")
+        if path.endswith("devices.json"):
+            endpoint = "github:devices.json"
+        else:
+            endpoint = f"updater:{path.split('/')[-1]}"
+        self.requests[endpoint] += 1
+        await asyncio.sleep(
+            max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if random.random() < self.error_rate:
+            return httpx.Response(503)
+        if endpoint == "github:devices.json":
+            return httpx.Response(200,
+                                  content=self.devices_content,
+                                  headers={"etag": '"benchmark"'})
+        return httpx.Response(200,
+                              json={
+                                  "response": [{
+                                      "datetime":
+                                      1700000000,
+                                      "size":
+                                      1500000000,
+                                      "version":
+                                      "17.0",
+                                      "url":
+                                      f"https://example.invalid{path}",
+                                  }]
+                              })
+
+
+# Telegram stand-ins
+class FakeTelegram:
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.message_ids = itertools.count(1)
+
+    async def call(self, method: str) -> None:
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeMessage:
+
+    def __init__(self,
+                 telegram: FakeTelegram,
+                 chat: SimpleNamespace,
+                 from_user: SimpleNamespace,
+                 text: str,
+                 reply_to_message: Optional["FakeMessage"] = None) -> None:
+        self.telegram = telegram
+        self.id = next(telegram.message_ids)
+        self.chat = chat
+        self.from_user = from_user
+        self.text = text
+        self.reply_to_message = reply_to_message
+
+    async def reply_text(self, text: str, *args, **kwargs) -> "FakeMessage":
+        await self.telegram.call("send_message")
+        return FakeMessage(self.telegram, self.chat, BOT_USER, text, self)
+
+    async def edit_text(self, text: str, *args, **kwargs) -> "FakeMessage":
+        await self.telegram.call("edit_message_text")
+        self.text = text
+        return self
+
+    async def delete(self, *args, **kwargs) -> bool:
+        await self.telegram.call("delete_messages")
+        return True
+
+
+class FakeClient:
+
+    def __init__(self, telegram: FakeTelegram) -> None:
+        self.telegram = telegram
+        self.me = BOT_USER
+
+    async def get_me(self) -> SimpleNamespace:
+        await self.telegram.call("get_me")
+        return BOT_USER
+
+    async def get_chat_member(self, chat_id: int,
+                              user_id: int) -> SimpleNamespace:
+        await self.telegram.call("get_chat_member")
+        return SimpleNamespace(privileges=SimpleNamespace(
+            can_delete_messages=True))
+
+    async def send_chat_action(self, *args, **kwargs) -> bool:
+        await self.telegram.call("send_chat_action")
+        return True
+
+    async def delete_messages(self, *args, **kwargs) -> int:
+        await self.telegram.call("delete_messages")
+        return 1
+
+
+# Runner
+async def run_command(name: str, call: Callable[[int, int], Awaitable],
+                      requests: int, users: int, upstream: Upstream,
+                      telegram: FakeTelegram) -> Dict:
+    latencies: List[float] = []
+    failures = 0
+    counter = itertools.count()
+    upstream_before = sum(upstream.requests.values())
+    telegram_before = sum(telegram.calls.values())
+
+    async def user_loop(user: int) -> None:
+        nonlocal failures
+        while (index := next(counter)) < requests:
+            started = time.perf_counter()
+            try:
+                await call(user, index)
+            except Exception as e:
+                failures += 1
+                print(f"{name} failed: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[user_loop(user) for user in range(users)])
+    elapsed = time.perf_counter() - started
+    return {
+        "command": name,
+        "requests": requests,
+        "users": users,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "upstream_requests": sum(upstream.requests.values()) - upstream_before,
+        "telegram_calls": sum(telegram.calls.values()) - telegram_before,
+    }
+
+
+def reset_caches(bliss) -> None:
+    bliss.device_catalog = None
+    bliss.devices_validators.clear()
+    bliss.build_cache.invalidate()
+
+
+async def run_benchmark(args: argparse.Namespace) -> List[Dict]:
+    import bliss
+
+    devices = make_devices(args.devices)
+    codenames = [device["codename"] for device in devices]
+    popular_codenames = codenames[:args.popular] if args.popular else codenames
+    upstream = Upstream(devices, args.latency / 1000, args.jitter / 1000,
+                        args.error_rate)
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+    client = FakeClient(telegram)
+    bliss.http_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(upstream.handle),
+        headers={"User-Agent": "BlissBot-Benchmark"})
+    bliss.bot_identity = BOT_USER
+    chat_type = (bliss.enums.ChatType.SUPERGROUP
+                 if args.group else bliss.enums.ChatType.PRIVATE)
+    sample_builds = {
+        variant["name"]: bliss.Build(
+            timestamp=1700000000,
+            size=1610612736,
+            version="17.0",
+            url=f"https://example.invalid/{variant['name']}")
+        for variant in bliss.BUILD_VARIANTS
+    }
+
+    def make_message(user: int, text: str) -> FakeMessage:
+        chat_id = -100 if args.group else 10000 + user
+        return FakeMessage(telegram, SimpleNamespace(id=chat_id,
+                                                     type=chat_type),
+                           SimpleNamespace(id=10000 + user), text)
+
+    async def call_devices_list(user: int, index: int) -> None:
+        await bliss.devices_list()
+
+    async def call_get_device_text(user: int, index: int) -> None:
+        codename = random.choice(codenames)
+        catalog = await bliss.devices_list()
+        bliss.get_device_text(device_builds=sample_builds,
+                              device_data=catalog.get(codename),
+                              device_codename=codename)
+
+    async def call_bliss_msg(user: int, index: int) -> None:
+        await bliss.bliss_msg(
+            client,
+            make_message(user, f"/bliss {random.choice(popular_codenames)}"))
+
+    async def call_list_msg(user: int, index: int) -> None:
+        await bliss.list_msg(client, make_message(user, "/list"))
+
+    commands: Dict[str, Callable[[int, int], Awaitable]] = {
+        "devices_list": call_devices_list,
+        "get_device_text": call_get_device_text,
+        "bliss_msg": call_bliss_msg,
+        "list_msg": call_list_msg,
+    }
+    results = []
+    try:
+        for name in args.commands:
+            if args.cold:
+                reset_caches(bliss)
+            results.append(await
+                           run_command(name, commands[name], args.requests,
+                                       args.users, upstream, telegram))
+    finally:
+        await bliss.deferred_deleter.stop()
+        await bliss.close_http_client()
+        await bliss.state_store.close()
+    return results
+
+
+def print_table(results: List[Dict]) -> None:
+    columns = [
+        "command", "requests", "users", "failures", "p50_ms", "p95_ms",
+        "p99_ms", "max_ms", "throughput_rps", "upstream_requests",
+        "telegram_calls"
+    ]
+    rows = [[
+        f"{result[column]:.2f}"
+        if isinstance(result[column], float) else str(result[column])
+        for column in columns
+    ] for result in results]
+    widths = [
+        max(len(column), *(len(row[index]) for row in rows))
+        for index, column in enumerate(columns)
+    ]
+    print("  ".join(
+        column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(
+            value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot's command pipeline offline.")
+    parser.add_argument("--devices", type=int, default=300)
+    parser.add_argument("--requests",
+                        type=int,
+                        default=500,
+                        help="requests per command")
+    parser.add_argument("--users",
+                        type=int,
+                        default=50,
+                        help="concurrent simulated users")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=50,
+                        help="upstream latency in ms")
+    parser.add_argument("--jitter",
+                        type=float,
+                        default=10,
+                        help="upstream latency jitter in ms")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0.0,
+                        help="fraction of upstream requests answered 503")
+    parser.add_argument("--telegram-latency",
+                        type=float,
+                        default=0,
+                        help="latency of each Telegram call in ms")
+    parser.add_argument("--popular",
+                        type=int,
+                        default=0,
+                        help="only ask /bliss for the first N devices")
+    parser.add_argument("--group",
+                        action="store_true",
+                        help="send commands from one group instead of "
+                        "private chats")
+    parser.add_argument("--cold",
+                        action="store_true",
+                        help="drop the catalog and build caches before "
+                        "each command")
+    parser.add_argument(
+        "--commands",
+        nargs="+",
+        default=["devices_list", "get_device_text", "bliss_msg", "list_msg"],
+        choices=["devices_list", "get_device_text", "bliss_msg", "list_msg"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="print results as JSON for comparing commits")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="bliss-benchmark-") as work_dir:
+        with open(os.path.join(work_dir, "config.yml"), "w") as f:
+            yaml.safe_dump(BENCHMARK_CONFIG, f)
+        os.chdir(work_dir)
+        sys.path.insert(0, REPO_DIR)
+        results = asyncio.run(run_benchmark(args))
+        os.chdir(REPO_DIR)
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "revision": get_revision(),
+                    "settings": vars(args),
+                    "results": results,
+                },
+                indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,31 @@
 import asyncio
 import datetime
+import functools
+import hashlib
 import html
 import json
 import os
-from typing import Dict, Final, List, Optional, Tuple
+import random
+import re
+import socket
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import (Awaitable, Callable, Dict, Final, Hashable, List, Optional,
+                    Set, Tuple)
 
 import httpx
 import humanfriendly
 import yaml
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from hydrogram import Client, enums, filters
-from hydrogram.types import (CallbackQuery, InlineKeyboardButton,
-                             InlineKeyboardMarkup, Message)
+from hydrogram import Client, enums, errors, filters, idle
+from hydrogram.types import (CallbackQuery, ChatMemberUpdated,
+                             InlineKeyboardButton, InlineKeyboardMarkup,
+                             InlineQuery, InlineQueryResultArticle,
+                             InputTextMessageContent, Message, User)
 
 
 # YAML Helper
@@ -21,9 +35,16 @@ def load_config(filename):
     return config
 
 
+def config_value(section: Dict, key: str, default, kind: type):
+    # Only a missing or blank key falls back, 0 is a valid setting
+    value = section.get(key)
+    return kind(default if value is None else value)
+
+
 config_data = load_config("config.yml")
 telegram_config = config_data["telegram"]
 bliss_config = config_data["bliss"]
+metrics_config = config_data.get("metrics") or {}
 
 # Constants
 API_ID: Final[int] = int(telegram_config["api_id"])
@@ -40,372 +61,2408 @@ TELEGRAM_GROUP_IDS: Final[List[int]] = [
     int(group_id) for group_id in telegram_config.get("group_ids")
     if group_id is not None
 ]
+DEFAULT_BUILD_VARIANTS: Final[List[Dict[str, str]]] = [
+    {
+        "name": "vanilla",
+        "label": "Vanilla"
+    },
+    {
+        "name": "gapps",
+        "label": "GApps"
+    },
+    {
+        "name": "pixelgapps",
+        "label": "Pixel Gapps"
+    },
+    {
+        "name": "foss",
+        "label": "FOSS"
+    },
+]
+BUILD_VARIANTS: Final[List[Dict[str, str]]] = [
+    variant
+    for variant in bliss_config.get("variants") or DEFAULT_BUILD_VARIANTS
+    if variant is not None
+]
+VARIANT_TIMEOUT: Final[float] = config_value(bliss_config, "variant_timeout",
+                                             10, float)
+BUILDS_DEADLINE: Final[float] = config_value(bliss_config, "builds_deadline",
+                                             15, float)
+HTTP2_ENABLED: Final[bool] = bool(bliss_config.get("http2"))
+HTTP_MAX_CONNECTIONS: Final[int] = config_value(bliss_config,
+                                                "max_connections", 20, int)
+HTTP_MAX_KEEPALIVE_CONNECTIONS: Final[int] = config_value(
+    bliss_config, "max_keepalive_connections", 10, int)
+HTTP_KEEPALIVE_EXPIRY: Final[float] = config_value(bliss_config,
+                                                   "keepalive_expiry", 30,
+                                                   float)
+UPSTREAM_TIMEOUT: Final[float] = config_value(bliss_config, "upstream_timeout",
+                                              5, float)
+UPSTREAM_RETRIES: Final[int] = config_value(bliss_config, "upstream_retries",
+                                            2, int)
+UPSTREAM_RETRY_BACKOFF: Final[float] = config_value(bliss_config,
+                                                    "retry_backoff", 0.2,
+                                                    float)
+UPSTREAM_RETRY_BACKOFF_MAX: Final[float] = config_value(
+    bliss_config, "retry_backoff_max", 2, float)
+# Seconds before a second copy of a slow request is sent, blank disables it
+UPSTREAM_HEDGE_DELAY: Final[Optional[float]] = float(
+    bliss_config["hedge_delay"]) if bliss_config.get("hedge_delay") else None
+BREAKER_FAILURES: Final[int] = config_value(bliss_config, "breaker_failures",
+                                            5, int)
+BREAKER_RESET: Final[float] = config_value(bliss_config, "breaker_reset", 30,
+                                           float)
+BUILD_CACHE_TTL: Final[float] = config_value(bliss_config, "cache_ttl", 300,
+                                             float)
+BUILD_CACHE_NEGATIVE_TTL: Final[float] = config_value(bliss_config,
+                                                      "negative_cache_ttl", 60,
+                                                      float)
+BUILD_CACHE_MAX_ENTRIES: Final[int] = config_value(bliss_config,
+                                                   "cache_max_entries", 1024,
+                                                   int)
+LIST_PAGE_SIZE: Final[int] = config_value(bliss_config, "list_page_size", 50,
+                                          int)
+LIST_GROUP_BY_BRAND: Final[bool] = bool(
+    bliss_config.get("list_group_by_brand"))
+# Telegram rejects messages over 4096 characters, leave room for the header
+LIST_PAGE_MAX_LENGTH: Final[int] = 3900
+INLINE_RESULTS_LIMIT: Final[int] = config_value(bliss_config,
+                                                "inline_results_limit", 5, int)
+INLINE_CACHE_TIME: Final[int] = config_value(bliss_config, "inline_cache_time",
+                                             60, int)
+BATCH_MAX_DEVICES: Final[int] = config_value(bliss_config, "batch_max_devices",
+                                             10, int)
+BATCH_CONCURRENCY: Final[int] = config_value(bliss_config, "batch_concurrency",
+                                             8, int)
+BATCH_CACHE_ENTRIES: Final[int] = config_value(bliss_config,
+                                               "batch_cache_entries", 256, int)
+OUTBOUND_CHAT_RATE: Final[float] = config_value(telegram_config, "chat_rate",
+                                                1, float)
+OUTBOUND_CHAT_BURST: Final[int] = config_value(telegram_config, "chat_burst",
+                                               5, int)
+OUTBOUND_GLOBAL_RATE: Final[float] = config_value(telegram_config,
+                                                  "global_rate", 25, float)
+OUTBOUND_GLOBAL_BURST: Final[int] = config_value(telegram_config,
+                                                 "global_burst", 30, int)
+OUTBOUND_FLOOD_RETRIES: Final[int] = config_value(telegram_config,
+                                                  "flood_retries", 3, int)
+OUTBOUND_MAX_FLOOD_WAIT: Final[float] = config_value(telegram_config,
+                                                     "max_flood_wait", 60,
+                                                     float)
+USER_COMMAND_RATE: Final[float] = config_value(telegram_config,
+                                               "user_command_rate", 0.2, float)
+USER_COMMAND_BURST: Final[int] = config_value(telegram_config,
+                                              "user_command_burst", 3, int)
+INLINE_QUERY_RATE: Final[float] = config_value(telegram_config,
+                                               "inline_query_rate", 2, float)
+INLINE_QUERY_BURST: Final[int] = config_value(telegram_config,
+                                              "inline_query_burst", 10, int)
+ANNOUNCE_BUILDS: Final[bool] = bool(
+    telegram_config.get("announce_builds", True))
+LIST_DELETE_DELAY: Final[float] = config_value(telegram_config,
+                                               "list_delete_delay", 10, float)
+PRIVILEGES_TTL: Final[float] = config_value(telegram_config, "privileges_ttl",
+                                            600, float)
+PREFETCH_INTERVAL: Final[float] = config_value(bliss_config,
+                                               "prefetch_interval", 30, float)
+PREFETCH_CONCURRENCY: Final[int] = config_value(bliss_config,
+                                                "prefetch_concurrency", 4, int)
+WARMUP_DEADLINE: Final[float] = config_value(bliss_config, "warmup_deadline",
+                                             30, float)
+SHUTDOWN_TIMEOUT: Final[float] = config_value(bliss_config, "shutdown_timeout",
+                                              10, float)
+DEVICES_FILE: Final[str] = "devices.json"
+METRICS_HOST: Final[str] = metrics_config.get("host") or "127.0.0.1"
+METRICS_PORT: Final[Optional[int]] = int(
+    metrics_config["port"]) if metrics_config.get("port") else None
+STATE_DB_FILE: Final[str] = bliss_config.get("state_db") or "bliss_state.db"
+STATE_BACKEND: Final[str] = bliss_config.get("state_backend") or "sqlite"
+REDIS_URL: Final[str] = bliss_config.get(
+    "redis_url") or "redis://localhost:6379/0"
+REDIS_PREFIX: Final[str] = bliss_config.get("redis_prefix") or "bliss"
+REPLICA_ID: Final[str] = str(
+    bliss_config.get("replica_id") or f"{socket.gethostname()}:{os.getpid()}")
+LEADER_LEASE: Final[float] = config_value(bliss_config, "leader_lease", 30,
+                                          float)
+CATALOG_SYNC_INTERVAL: Final[float] = config_value(bliss_config,
+                                                   "catalog_sync_interval", 60,
+                                                   float)
+DEVICES_URL: Final[
+    str] = "https://raw.githubusercontent.com/BlissRoms-Devices/official-devices/main/devices.json"
 
 # hydrogram Client
 app = Client("BlissBot", bot_token=BOT_TOKEN, api_id=API_ID, api_hash=API_HASH)
 
 
-# Scheduled Jobs
-async def download_devices_job() -> None:
-    devices_file = "devices.json"
-    devices_url = "https://raw.githubusercontent.com/BlissRoms-Devices/official-devices/main/devices.json"
-    if os.path.isfile(devices_file):
-        if RQST_USER_AGENT:
-            headers = {"User-Agent": RQST_USER_AGENT}
-        else:
-            headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-        new_devices_file = "new_devices.json"
-        async with httpx.AsyncClient(headers=headers) as client:
-            response = await client.get(devices_url)
-            if response.status_code != 200:
-                print(
-                    f"Request failed with status code: {response.status_code}")
-                return None
-            with open(new_devices_file, "w") as f:
-                json.dump(json.loads(response.text), f)
-        if os.path.getsize(devices_file) != os.path.getsize(new_devices_file):
-            os.remove(devices_file)
-            os.rename(new_devices_file, devices_file)
+# Metrics
+class Metrics:
+    buckets: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                                  2.5, 5, 10)
+
+    def __init__(self) -> None:
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]],
+                            float] = {}
+        # (name, labels) -> [bucket counts..., count, sum]
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]],
+                              List[float]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = [0.0] * (len(self.buckets) + 2)
+            self.histograms[key] = histogram
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+    def gauge(self, name: str, function: Callable[[], float]) -> None:
+        self.gauges[name] = function
+
+    @staticmethod
+    def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"'
+                              for key, value in labels) + "}"
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines: List[str] = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in self.counters.items():
+                if counter_name == name:
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in self.histograms.items():
+                if histogram_name != name:
+                    continue
+                for bucket, count in zip(self.buckets + (float("inf"), ),
+                                         histogram[:-2] + [histogram[-2]]):
+                    bucket_labels = labels + (
+                        ("le",
+                         "+Inf" if bucket == float("inf") else str(bucket)), )
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(bucket_labels)} {count}"
+                    )
+                lines.append(
+                    f"{name}_count{self.format_labels(labels)} {histogram[-2]}"
+                )
+                lines.append(
+                    f"{name}_sum{self.format_labels(labels)} {histogram[-1]}")
+        for name, function in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {function()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+event_loop_lag = 0.0
+
+
+def instrument_handler(command: str) -> Callable:
+
+    def decorator(handler: Callable[..., Awaitable]) -> Callable:
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                metrics.inc("bliss_handler_errors_total", command=command)
+                raise
+            finally:
+                metrics.observe("bliss_handler_seconds",
+                                time.perf_counter() - started,
+                                command=command)
+
+        return wrapper
+
+    return decorator
+
+
+async def monitor_event_loop(interval: float = 1) -> None:
+    global event_loop_lag
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag = max(time.perf_counter() - started - interval, 0)
+        metrics.observe("bliss_event_loop_lag_seconds", event_loop_lag)
+
+
+async def serve_metrics(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        if request_line.split()[:2] == [b"GET", b"/metrics"]:
+            status, body = "200 OK", metrics.render().encode()
         else:
-            os.remove(new_devices_file)
-    else:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(devices_url)
-            if response.status_code != 200:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            .encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+# Shared HTTP Client
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http2 = HTTP2_ENABLED
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
                 print(
-                    f"Request failed with status code: {response.status_code}")
-                return None
-            with open(devices_file, "w") as f:
-                json.dump(json.loads(response.text), f)
+                    "HTTP/2 requested but h2 is not installed, using HTTP/1.1")
+                http2 = False
+        http_client = httpx.AsyncClient(
+            headers={"User-Agent": RQST_USER_AGENT or DEFAULT_RQST_USER_AGENT},
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT),
+            http2=http2)
+    return http_client
 
 
-# Helper Functions
-async def devices_list() -> Optional[Dict[str, Dict[str, str]]]:
-    devices_file = "devices.json"
-    devices: Dict[str, str] = {}
+class UpstreamUnavailable(httpx.HTTPError):
+    pass
+
+
+class CircuitBreaker:
+    # Closed until `failures` consecutive failures, then open (requests fail
+    # fast) for `reset_timeout` seconds, then half-open: one probe decides.
+
+    def __init__(self, host: str, failures: int, reset_timeout: float) -> None:
+        self.host = host
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None and time.monotonic(
+        ) - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.is_open():
+            return False
+        # Half-open: let one probe through and hold everything else back
+        # until it settles or another reset_timeout passes.
+        self.opened_at = time.monotonic()
+        self.probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            print(f"Circuit closed for {self.host}")
+            metrics.inc("bliss_upstream_circuit_transitions_total",
+                        host=self.host,
+                        state="closed")
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.probing or (self.opened_at is None
+                            and self.consecutive_failures >= self.failures):
+            print(f"Circuit opened for {self.host}")
+            metrics.inc("bliss_upstream_circuit_transitions_total",
+                        host=self.host,
+                        state="open")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+metrics.gauge(
+    "bliss_upstream_circuits_open",
+    lambda: sum(breaker.is_open() for breaker in circuit_breakers.values()))
+
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    host = httpx.URL(url).host
+    breaker = circuit_breakers.get(host)
+    if breaker is None:
+        breaker = CircuitBreaker(host, BREAKER_FAILURES, BREAKER_RESET)
+        circuit_breakers[host] = breaker
+    return breaker
+
+
+def is_retryable(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+
+async def hedged_get(client: httpx.AsyncClient, url: str,
+                     headers: Optional[Dict[str, str]]) -> httpx.Response:
+    # GETs are idempotent, so a slow request gets a second copy and the
+    # first good answer wins.
+    if UPSTREAM_HEDGE_DELAY is None:
+        return await client.get(url, headers=headers)
+    first = asyncio.create_task(client.get(url, headers=headers))
+    tasks = {first}
     try:
-        with open(devices_file, "r") as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        devices_url = "https://raw.githubusercontent.com/BlissRoms-Devices/official-devices/main/devices.json"
-        if RQST_USER_AGENT:
-            headers = {"User-Agent": RQST_USER_AGENT}
+        done, _ = await asyncio.wait(tasks, timeout=UPSTREAM_HEDGE_DELAY)
+        if done:
+            return first.result()
+        metrics.inc("bliss_upstream_hedges_total")
+        tasks.add(asyncio.create_task(client.get(url, headers=headers)))
+        error: Optional[BaseException] = None
+        while tasks:
+            done, tasks = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif not is_retryable(task.result()) or not tasks:
+                    return task.result()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def upstream_get(
+        url: str,
+        endpoint: str,
+        variant: str = "",
+        headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    # Retries transport errors, 429 and 5xx with full-jitter backoff; an
+    # open circuit fails fast with UpstreamUnavailable.
+    client = get_http_client()
+    breaker = get_circuit_breaker(url)
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if not breaker.allow():
+            metrics.inc("bliss_upstream_requests_total",
+                        endpoint=endpoint,
+                        variant=variant,
+                        status="circuit_open")
+            raise UpstreamUnavailable(f"Circuit open for {breaker.host}")
+        if attempt > 0:
+            metrics.inc("bliss_upstream_retries_total",
+                        endpoint=endpoint,
+                        variant=variant)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await hedged_get(client, url, headers)
+            status = str(response.status_code)
+        except httpx.TransportError:
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                raise
         else:
-            headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-        async with httpx.AsyncClient(headers=headers) as client:
-            response = await client.get(devices_url)
-            if response.status_code != 200:
-                print(
-                    f"Request failed with status code: {response.status_code}")
-                return None
-            data = json.loads(response.text)
-            with open(devices_file, "w") as f:
-                json.dump(data, f)
-    for device in data:
-        device_data: Dict[str, str] = {
-            'brand': device['brand'],
-            'name': device['name'],
-            'maintainer': device['supported_versions'][0]['maintainer_name'],
-            'support': device['supported_versions'][0]['support_thread'],
+            if not is_retryable(response):
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                return response
+        finally:
+            metrics.observe("bliss_upstream_seconds",
+                            time.perf_counter() - started,
+                            endpoint=endpoint,
+                            variant=variant)
+            metrics.inc("bliss_upstream_requests_total",
+                        endpoint=endpoint,
+                        variant=variant,
+                        status=status)
+        await asyncio.sleep(
+            random.uniform(
+                0,
+                min(UPSTREAM_RETRY_BACKOFF_MAX,
+                    UPSTREAM_RETRY_BACKOFF * 2**attempt)))
+
+
+async def close_http_client() -> None:
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+# Models
+def require_field(data: Dict, key: str, kind: type):
+    value = data.get(key)
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ValueError(f"invalid or missing '{key}': {value!r}")
+    return value
+
+
+@dataclass(frozen=True, slots=True)
+class Device:
+    codename: str
+    brand: str
+    name: str
+    maintainer: str
+    support: str
+
+    @classmethod
+    def decode(cls, data: Dict) -> "Device":
+        supported_versions = data.get('supported_versions')
+        if not isinstance(supported_versions, list) or not supported_versions:
+            raise ValueError(
+                f"device {data.get('codename')!r} has no supported_versions")
+        supported_version = supported_versions[0]
+        if not isinstance(supported_version, dict):
+            raise ValueError(
+                f"device {data.get('codename')!r} has an invalid supported_versions entry"
+            )
+        return cls(codename=require_field(data, 'codename', str),
+                   brand=require_field(data, 'brand', str),
+                   name=require_field(data, 'name', str),
+                   maintainer=str(
+                       supported_version.get('maintainer_name') or ""),
+                   support=str(supported_version.get('support_thread') or ""))
+
+
+@dataclass(frozen=True, slots=True)
+class Build:
+    timestamp: int
+    size: int
+    version: str
+    url: str
+    # Formatted once when the build is decoded, not on every reply
+    date_text: str = field(init=False)
+    size_text: str = field(init=False)
+    # Last known good copy served while the update server is unreachable
+    stale: bool = field(default=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(
+            self, 'date_text',
+            datetime.datetime.fromtimestamp(
+                self.timestamp).strftime('%d-%m-%Y'))
+        object.__setattr__(self, 'size_text',
+                           humanfriendly.format_size(self.size))
+
+    @classmethod
+    def decode(cls, data: Dict) -> "Build":
+        if not isinstance(data, dict):
+            raise ValueError(f"invalid build entry: {data!r}")
+        url = require_field(data, 'url', str)
+        if not url:
+            raise ValueError("build has an empty 'url'")
+        return cls(timestamp=int(require_field(data, 'datetime',
+                                               (int, float))),
+                   size=int(require_field(data, 'size', (int, float))),
+                   version=str(
+                       require_field(data, 'version', (str, int, float))),
+                   url=url)
+
+    def encode(self) -> Dict:
+        return {
+            'datetime': self.timestamp,
+            'size': self.size,
+            'version': self.version,
+            'url': self.url,
         }
-        device_codename: str = device['codename']
-        devices[device_codename] = device_data
-    return devices
 
 
-async def get_device_info(device_codename: str) -> Optional[Dict[str, str]]:
-    devices_file = "devices.json"
+# Device Catalog
+def search_tokens(text: str) -> List[str]:
+    return [token for token in re.split(r"[^0-9a-z]+", text.lower()) if token]
+
+
+def get_trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class DeviceCatalog:
+
+    def __init__(self, data: List[Dict], content_hash: str = "") -> None:
+        self.content_hash = content_hash
+        self.devices: Dict[str, Device] = {}
+        self.codenames_lower: Dict[str, str] = {}
+        self.brands: Dict[str, List[str]] = {}
+        for entry in data:
+            # One broken upstream entry must not take the whole list down
+            try:
+                device = Device.decode(entry)
+            except (ValueError, AttributeError) as e:
+                print(f"Skipping malformed device entry: {e}")
+                continue
+            self.devices[device.codename] = device
+            self.codenames_lower[device.codename.lower()] = device.codename
+            self.brands.setdefault(device.brand.lower(),
+                                   []).append(device.codename)
+        self.list_pages: List[str] = self.render_list_pages()
+        # Search index: every prefix of every codename/brand/name token, and
+        # trigrams of the whole searchable text for substring and typo hits.
+        self.search_texts: Dict[str, str] = {}
+        self.search_prefixes: Dict[str, Set[str]] = {}
+        self.search_trigrams: Dict[str, Set[str]] = {}
+        for device_codename, device in self.devices.items():
+            search_text = " ".join(
+                search_tokens(
+                    f"{device_codename} {device.brand} {device.name}"))
+            self.search_texts[device_codename] = search_text
+            for token in search_text.split():
+                for end in range(1, len(token) + 1):
+                    self.search_prefixes.setdefault(token[:end],
+                                                    set()).add(device_codename)
+            for trigram in get_trigrams(search_text):
+                self.search_trigrams.setdefault(trigram,
+                                                set()).add(device_codename)
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "DeviceCatalog":
+        # An error body served with a 200 must not replace a good list
+        data = json.loads(content)
+        if not isinstance(data, list):
+            raise ValueError(
+                f"device list is a {type(data).__name__}, not a list")
+        catalog = cls(data, hashlib.sha256(content).hexdigest())
+        if not catalog.devices:
+            raise ValueError("device list has no valid devices")
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def resolve(self, device_codename: str) -> Optional[str]:
+        if device_codename in self.devices:
+            return device_codename
+        return self.codenames_lower.get(device_codename.lower())
+
+    def get(self, device_codename: str) -> Optional[Device]:
+        resolved_codename = self.resolve(device_codename)
+        if resolved_codename is None:
+            return None
+        return self.devices[resolved_codename]
+
+    def by_brand(self, brand: str) -> List[str]:
+        return self.brands.get(brand.lower(), [])
+
+    def search_term(self, term: str) -> Set[str]:
+        matches = self.search_prefixes.get(term)
+        if matches:
+            return matches
+        trigrams = get_trigrams(term)
+        if not trigrams:
+            return set()
+        trigram_hits: Dict[str, int] = {}
+        for trigram in trigrams:
+            for device_codename in self.search_trigrams.get(trigram, ()):
+                trigram_hits[device_codename] = trigram_hits.get(
+                    device_codename, 0) + 1
+        substring_matches = {
+            device_codename
+            for device_codename, hits in trigram_hits.items()
+            if hits == len(trigrams)
+            and term in self.search_texts[device_codename]
+        }
+        if substring_matches:
+            return substring_matches
+        # Fuzzy fallback: at least half of the term's trigrams must match
+        return {
+            device_codename
+            for device_codename, hits in trigram_hits.items()
+            if hits * 2 >= len(trigrams)
+        }
+
+    def search(self, query: str, limit: int) -> List[str]:
+        terms = search_tokens(query)
+        if not terms:
+            return list(self.devices)[:limit]
+        matches: Optional[Set[str]] = None
+        for term in terms:
+            term_matches = self.search_term(term)
+            matches = term_matches if matches is None else matches & term_matches
+            if not matches:
+                return []
+        first_term = terms[0]
+
+        def rank(device_codename: str) -> Tuple[bool, bool, str]:
+            codename_lower = device_codename.lower()
+            exact = codename_lower == first_term
+            prefix = codename_lower.startswith(first_term)
+            return not exact, not prefix, self.search_texts[device_codename]
+
+        return sorted(matches, key=rank)[:limit]
+
+    def render_list_line(self, device_codename: str) -> str:
+        device = self.devices[device_codename]
+        return f"{html.escape(device.brand)} {html.escape(device.name)} (<code>{html.escape(device_codename)}</code>)"
+
+    def render_list_pages(self) -> List[str]:
+        lines: List[str] = []
+        if LIST_GROUP_BY_BRAND:
+            for brand in sorted(self.brands):
+                brand_codenames = self.brands[brand]
+                lines.append(
+                    f"\n<strong>{html.escape(self.devices[brand_codenames[0]].brand)}</strong>"
+                )
+                lines.extend(
+                    self.render_list_line(device_codename)
+                    for device_codename in brand_codenames)
+        else:
+            lines.extend(
+                self.render_list_line(device_codename)
+                for device_codename in self.devices)
+        pages: List[str] = []
+        page_lines: List[str] = []
+        page_length = 0
+        for line in lines:
+            if page_lines and (len(page_lines) >= LIST_PAGE_SIZE
+                               or page_length + len(line)
+                               >= LIST_PAGE_MAX_LENGTH):
+                pages.append("\n".join(page_lines).strip())
+                page_lines = []
+                page_length = 0
+            page_lines.append(line)
+            page_length += len(line) + 1
+        if page_lines:
+            pages.append("\n".join(page_lines).strip())
+        return pages
+
+
+device_catalog: Optional[DeviceCatalog] = None
+device_catalog_lock = asyncio.Lock()
+
+
+def read_devices_file(devices_file: str) -> Optional[DeviceCatalog]:
     try:
-        with open(devices_file, "r") as f:
-            data = json.load(f)
+        with open(devices_file, "rb") as f:
+            return DeviceCatalog.from_bytes(f.read())
     except FileNotFoundError:
-        await download_devices_job()
-    for device in data:
-        if device['codename'] != device_codename:
-            continue
+        return None
+    except (ValueError, TypeError) as e:
+        print(f"{devices_file} is invalid: {e!r}")
+        return None
+
+
+def write_devices_file(devices_file: str, content: bytes) -> None:
+    # Write next to the target and rename over it, so readers only ever see
+    # the old or the new file and never a partial one.
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(devices_file)),
+                                     prefix=".devices.",
+                                     suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, devices_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+# State Store
+class StateStore(ABC):
+    # Shared state of every replica: the catalog, fetched builds, announced
+    # releases, pending deletions and the leader lease.
+
+    @abstractmethod
+    async def load_catalog(
+            self) -> Optional[Tuple[bytes, Optional[str], Optional[str]]]:
+        ...
+
+    @abstractmethod
+    async def save_catalog(self, content: bytes, etag: Optional[str],
+                           last_modified: Optional[str]) -> None:
+        ...
+
+    @abstractmethod
+    async def load_builds(
+            self, limit: int) -> List[Tuple[str, str, float, Optional[Build]]]:
+        ...
+
+    @abstractmethod
+    async def load_build(
+            self, device_codename: str,
+            variant: str) -> Optional[Tuple[float, Optional[Build]]]:
+        ...
+
+    @abstractmethod
+    async def save_build(self, device_codename: str, variant: str,
+                         fetched_at: float, build: Optional[Build]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_builds(self, device_codename: str) -> None:
+        ...
+
+    @abstractmethod
+    async def load_seen_builds(self) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        ...
+
+    @abstractmethod
+    async def save_seen_builds(self, rows: List[Tuple[str, str, str,
+                                                      str]]) -> None:
+        ...
+
+    @abstractmethod
+    async def add_deletions(self, rows: List[Tuple[int, int, float]]) -> None:
+        ...
+
+    @abstractmethod
+    async def load_due_deletions(
+            self, now: float) -> Tuple[Dict[int, List[int]], Optional[float]]:
+        ...
+
+    @abstractmethod
+    async def remove_deletions(self, chat_id: int,
+                               message_ids: List[int]) -> None:
+        ...
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        # Takes a free or expired lease, or renews one already held
+        ...
+
+    @abstractmethod
+    async def release_lease(self, name: str, holder: str) -> None:
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+def decode_stored_build(build: Optional[str]) -> Optional[Build]:
+    if build is None:
+        return None
+    return Build.decode(json.loads(build))
+
+
+class SQLiteStateStore(StateStore):
+    # One database file, shared by replicas on the same host through
+    # sqlite's own file locking.
+
+    def __init__(self, database_file: str) -> None:
+        self.database_file = database_file
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = asyncio.Lock()
+
+    def open_database(self) -> None:
+        self.connection = sqlite3.connect(self.database_file,
+                                          timeout=30,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS deferred_deletions (chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, due_at REAL NOT NULL, PRIMARY KEY (chat_id, message_id))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS catalog (id INTEGER PRIMARY KEY CHECK (id = 1), content BLOB NOT NULL, etag TEXT, last_modified TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS builds (codename TEXT NOT NULL, variant TEXT NOT NULL, fetched_at REAL NOT NULL, build TEXT, PRIMARY KEY (codename, variant))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen_builds (codename TEXT NOT NULL, variant TEXT NOT NULL, version TEXT NOT NULL, datetime TEXT NOT NULL, PRIMARY KEY (codename, variant))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    async def execute(self, function: Callable, *args):
+        # sqlite calls run in a worker thread, one at a time
+        async with self.lock:
+            if self.connection is None:
+                await asyncio.to_thread(self.open_database)
+            return await asyncio.to_thread(function, self.connection, *args)
+
+    async def close(self) -> None:
+        async with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    @staticmethod
+    def select_catalog(
+        connection: sqlite3.Connection
+    ) -> Optional[Tuple[bytes, Optional[str], Optional[str]]]:
+        return connection.execute(
+            "SELECT content, etag, last_modified FROM catalog WHERE id = 1"
+        ).fetchone()
+
+    async def load_catalog(
+            self) -> Optional[Tuple[bytes, Optional[str], Optional[str]]]:
+        return await self.execute(self.select_catalog)
+
+    @staticmethod
+    def insert_catalog(connection: sqlite3.Connection, content: bytes,
+                       etag: Optional[str],
+                       last_modified: Optional[str]) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO catalog VALUES (1, ?, ?, ?)",
+            (content, etag, last_modified))
+        connection.commit()
+
+    async def save_catalog(self, content: bytes, etag: Optional[str],
+                           last_modified: Optional[str]) -> None:
+        await self.execute(self.insert_catalog, content, etag, last_modified)
+
+    @staticmethod
+    def select_builds(
+            connection: sqlite3.Connection,
+            limit: int) -> List[Tuple[str, str, float, Optional[Build]]]:
+        builds: List[Tuple[str, str, float, Optional[Build]]] = []
+        for device_codename, variant, fetched_at, build in connection.execute(
+                "SELECT codename, variant, fetched_at, build FROM builds ORDER BY fetched_at DESC LIMIT ?",
+            (limit, )):
+            try:
+                builds.append((device_codename, variant, fetched_at,
+                               decode_stored_build(build)))
+            except ValueError as e:
+                print(
+                    f"Skipping stored build {device_codename}/{variant}: {e}")
+        return builds
+
+    async def load_builds(
+            self, limit: int) -> List[Tuple[str, str, float, Optional[Build]]]:
+        return await self.execute(self.select_builds, limit)
+
+    @staticmethod
+    def select_build(connection: sqlite3.Connection, device_codename: str,
+                     variant: str) -> Optional[Tuple[float, Optional[Build]]]:
+        row = connection.execute(
+            "SELECT fetched_at, build FROM builds WHERE codename = ? AND variant = ?",
+            (device_codename, variant)).fetchone()
+        if row is None:
+            return None
+        try:
+            return row[0], decode_stored_build(row[1])
+        except ValueError:
+            return None
+
+    async def load_build(
+            self, device_codename: str,
+            variant: str) -> Optional[Tuple[float, Optional[Build]]]:
+        return await self.execute(self.select_build, device_codename, variant)
+
+    @staticmethod
+    def insert_build(connection: sqlite3.Connection, device_codename: str,
+                     variant: str, fetched_at: float,
+                     build: Optional[Build]) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?)",
+            (device_codename, variant, fetched_at,
+             json.dumps(build.encode()) if build is not None else None))
+        connection.commit()
+
+    async def save_build(self, device_codename: str, variant: str,
+                         fetched_at: float, build: Optional[Build]) -> None:
+        await self.execute(self.insert_build, device_codename, variant,
+                           fetched_at, build)
+
+    @staticmethod
+    def delete_build_rows(connection: sqlite3.Connection,
+                          device_codename: str) -> None:
+        connection.execute("DELETE FROM builds WHERE codename = ?",
+                           (device_codename, ))
+        connection.commit()
+
+    async def delete_builds(self, device_codename: str) -> None:
+        await self.execute(self.delete_build_rows, device_codename)
+
+    @staticmethod
+    def select_seen_builds(
+        connection: sqlite3.Connection
+    ) -> Dict[Tuple[str, str], Tuple[str, str]]:
         return {
-            'brand': device['brand'],
-            'name': device['name'],
-            'maintainer': device['supported_versions'][0]['maintainer_name'],
-            'support': device['supported_versions'][0]['support_thread'],
+            (device_codename, variant): (version, build_datetime)
+            for device_codename, variant, version, build_datetime in
+            connection.execute("SELECT * FROM seen_builds")
         }
 
+    async def load_seen_builds(self) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        return await self.execute(self.select_seen_builds)
 
-async def get_vanilla_build(device_codename: str) -> Optional[Dict[str, str]]:
-    download_url = DOWNLOAD_BASE_URL.format(device_codename, "vanilla")
-    build_data: Dict[str, str] = {}
-    if RQST_USER_AGENT:
-        headers = {"User-Agent": RQST_USER_AGENT}
-    else:
-        headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(download_url)
-        if response.status_code != 200:
-            print(f"Request failed with status code: {response.status_code}")
+    @staticmethod
+    def insert_seen_builds(connection: sqlite3.Connection,
+                           rows: List[Tuple[str, str, str, str]]) -> None:
+        connection.executemany(
+            "INSERT OR REPLACE INTO seen_builds VALUES (?, ?, ?, ?)", rows)
+        connection.commit()
+
+    async def save_seen_builds(self, rows: List[Tuple[str, str, str,
+                                                      str]]) -> None:
+        await self.execute(self.insert_seen_builds, rows)
+
+    @staticmethod
+    def insert_deletions(connection: sqlite3.Connection,
+                         rows: List[Tuple[int, int, float]]) -> None:
+        connection.executemany(
+            "INSERT OR REPLACE INTO deferred_deletions VALUES (?, ?, ?)", rows)
+        connection.commit()
+
+    async def add_deletions(self, rows: List[Tuple[int, int, float]]) -> None:
+        await self.execute(self.insert_deletions, rows)
+
+    @staticmethod
+    def select_due_deletions(
+            connection: sqlite3.Connection,
+            now: float) -> Tuple[Dict[int, List[int]], Optional[float]]:
+        due: Dict[int, List[int]] = {}
+        for chat_id, message_id in connection.execute(
+                "SELECT chat_id, message_id FROM deferred_deletions WHERE due_at <= ?",
+            (now, )):
+            due.setdefault(chat_id, []).append(message_id)
+        next_due_at = connection.execute(
+            "SELECT MIN(due_at) FROM deferred_deletions WHERE due_at > ?",
+            (now, )).fetchone()[0]
+        return due, next_due_at
+
+    async def load_due_deletions(
+            self, now: float) -> Tuple[Dict[int, List[int]], Optional[float]]:
+        return await self.execute(self.select_due_deletions, now)
+
+    @staticmethod
+    def delete_deletion_rows(connection: sqlite3.Connection, chat_id: int,
+                             message_ids: List[int]) -> None:
+        connection.executemany(
+            "DELETE FROM deferred_deletions WHERE chat_id = ? AND message_id = ?",
+            [(chat_id, message_id) for message_id in message_ids])
+        connection.commit()
+
+    async def remove_deletions(self, chat_id: int,
+                               message_ids: List[int]) -> None:
+        await self.execute(self.delete_deletion_rows, chat_id, message_ids)
+
+    @staticmethod
+    def upsert_lease(connection: sqlite3.Connection, name: str, holder: str,
+                     ttl: float) -> bool:
+        now = time.time()
+        with connection:
+            connection.execute(
+                "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at WHERE leases.holder = excluded.holder OR leases.expires_at <= ?",
+                (name, holder, now + ttl, now))
+            return connection.execute(
+                "SELECT holder FROM leases WHERE name = ?",
+                (name, )).fetchone()[0] == holder
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        return await self.execute(self.upsert_lease, name, holder, ttl)
+
+    @staticmethod
+    def delete_lease(connection: sqlite3.Connection, name: str,
+                     holder: str) -> None:
+        connection.execute("DELETE FROM leases WHERE name = ? AND holder = ?",
+                           (name, holder))
+        connection.commit()
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self.execute(self.delete_lease, name, holder)
+
+
+class RedisStateStore(StateStore):
+    # Works with any client exposing the redis-py asyncio API, so Redis,
+    # Valkey, KeyDB or an in-process stand-in can back it.
+    renew_lease_script: Final[str] = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end")
+    release_lease_script: Final[str] = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def __init__(self, client, prefix: str) -> None:
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def load_catalog(
+            self) -> Optional[Tuple[bytes, Optional[str], Optional[str]]]:
+        catalog = await self.client.hgetall(self.key("catalog"))
+        if not catalog or b"content" not in catalog:
             return None
-        device_data = json.loads(response.text)['response'][0]
-        build_data = {
-            'date':
-            datetime.datetime.fromtimestamp(
-                device_data['datetime']).strftime('%d-%m-%Y'),
-            'size':
-            humanfriendly.format_size(device_data['size']),
-            'version':
-            device_data['version'],
-            'url':
-            device_data['url'],
-        }
-        return build_data
+        return (catalog[b"content"], catalog.get(b"etag", b"").decode()
+                or None, catalog.get(b"last_modified", b"").decode() or None)
 
+    async def save_catalog(self, content: bytes, etag: Optional[str],
+                           last_modified: Optional[str]) -> None:
+        await self.client.hset(self.key("catalog"),
+                               mapping={
+                                   "content": content,
+                                   "etag": etag or "",
+                                   "last_modified": last_modified or "",
+                               })
 
-async def get_gapps_build(device_codename: str) -> Optional[Dict[str, str]]:
-    download_url = DOWNLOAD_BASE_URL.format(device_codename, "gapps")
-    build_data: Dict[str, str] = {}
-    if RQST_USER_AGENT:
-        headers = {"User-Agent": RQST_USER_AGENT}
-    else:
-        headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(download_url)
-        if response.status_code != 200:
-            print(f"Request failed with status code: {response.status_code}")
+    @staticmethod
+    def decode_build_entry(
+            device_codename: str, variant: str,
+            entry: bytes) -> Optional[Tuple[float, Optional[Build]]]:
+        try:
+            stored = json.loads(entry)
+            build = stored["build"]
+            return float(stored["fetched_at"]), Build.decode(
+                build) if build is not None else None
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skipping stored build {device_codename}/{variant}: {e}")
             return None
-        device_data = json.loads(response.text)['response'][0]
-        build_data = {
-            'date':
-            datetime.datetime.fromtimestamp(
-                device_data['datetime']).strftime('%d-%m-%Y'),
-            'size':
-            humanfriendly.format_size(device_data['size']),
-            'version':
-            device_data['version'],
-            'url':
-            device_data['url'],
-        }
-        return build_data
 
+    async def load_builds(
+            self, limit: int) -> List[Tuple[str, str, float, Optional[Build]]]:
+        builds: List[Tuple[str, str, float, Optional[Build]]] = []
+        for field_name, entry in (await self.client.hgetall(self.key("builds")
+                                                            )).items():
+            device_codename, variant = field_name.decode().split("/", 1)
+            stored = self.decode_build_entry(device_codename, variant, entry)
+            if stored is not None:
+                builds.append((device_codename, variant, *stored))
+        builds.sort(key=lambda stored: stored[2], reverse=True)
+        return builds[:limit]
 
-async def get_pixelgapps_build(
-        device_codename: str) -> Optional[Dict[str, str]]:
-    download_url = DOWNLOAD_BASE_URL.format(device_codename, "pixelgapps")
-    build_data: Dict[str, str] = {}
-    if RQST_USER_AGENT:
-        headers = {"User-Agent": RQST_USER_AGENT}
-    else:
-        headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(download_url)
-        if response.status_code != 200:
-            print(f"Request failed with status code: {response.status_code}")
+    async def load_build(
+            self, device_codename: str,
+            variant: str) -> Optional[Tuple[float, Optional[Build]]]:
+        entry = await self.client.hget(self.key("builds"),
+                                       f"{device_codename}/{variant}")
+        if entry is None:
             return None
-        device_data = json.loads(response.text)['response'][0]
-        build_data = {
-            'date':
-            datetime.datetime.fromtimestamp(
-                device_data['datetime']).strftime('%d-%m-%Y'),
-            'size':
-            humanfriendly.format_size(device_data['size']),
-            'version':
-            device_data['version'],
-            'url':
-            device_data['url'],
-        }
-        return build_data
+        return self.decode_build_entry(device_codename, variant, entry)
 
+    async def save_build(self, device_codename: str, variant: str,
+                         fetched_at: float, build: Optional[Build]) -> None:
+        await self.client.hset(
+            self.key("builds"), f"{device_codename}/{variant}",
+            json.dumps({
+                "fetched_at": fetched_at,
+                "build": build.encode() if build is not None else None,
+            }))
 
-async def get_foss_build(device_codename: str) -> Optional[Dict[str, str]]:
-    download_url = DOWNLOAD_BASE_URL.format(device_codename, "foss")
-    build_data: Dict[str, str] = {}
-    if RQST_USER_AGENT:
-        headers = {"User-Agent": RQST_USER_AGENT}
-    else:
-        headers = {"User-Agent": DEFAULT_RQST_USER_AGENT}
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(download_url)
-        if response.status_code != 200:
-            print(f"Request failed with status code: {response.status_code}")
+    async def delete_builds(self, device_codename: str) -> None:
+        fields = [
+            field_name
+            for field_name in await self.client.hkeys(self.key("builds"))
+            if field_name.decode().startswith(f"{device_codename}/")
+        ]
+        if fields:
+            await self.client.hdel(self.key("builds"), *fields)
+
+    async def load_seen_builds(self) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        seen_builds: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        for field_name, release in (await
+                                    self.client.hgetall(self.key("seen_builds")
+                                                        )).items():
+            device_codename, variant = field_name.decode().split("/", 1)
+            version, build_datetime = json.loads(release)
+            seen_builds[(device_codename, variant)] = (version, build_datetime)
+        return seen_builds
+
+    async def save_seen_builds(self, rows: List[Tuple[str, str, str,
+                                                      str]]) -> None:
+        await self.client.hset(
+            self.key("seen_builds"),
+            mapping={
+                f"{device_codename}/{variant}":
+                json.dumps([version, build_datetime])
+                for device_codename, variant, version, build_datetime in rows
+            })
+
+    async def add_deletions(self, rows: List[Tuple[int, int, float]]) -> None:
+        await self.client.zadd(
+            self.key("deferred_deletions"), {
+                f"{chat_id}:{message_id}": due_at
+                for chat_id, message_id, due_at in rows
+            })
+
+    async def load_due_deletions(
+            self, now: float) -> Tuple[Dict[int, List[int]], Optional[float]]:
+        due: Dict[int, List[int]] = {}
+        for member in await self.client.zrangebyscore(
+                self.key("deferred_deletions"), "-inf", now):
+            chat_id, message_id = member.decode().split(":")
+            due.setdefault(int(chat_id), []).append(int(message_id))
+        upcoming = await self.client.zrangebyscore(
+            self.key("deferred_deletions"),
+            f"({now}",
+            "+inf",
+            start=0,
+            num=1,
+            withscores=True)
+        return due, upcoming[0][1] if upcoming else None
+
+    async def remove_deletions(self, chat_id: int,
+                               message_ids: List[int]) -> None:
+        await self.client.zrem(
+            self.key("deferred_deletions"),
+            *[f"{chat_id}:{message_id}" for message_id in message_ids])
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        key = self.key(f"lease:{name}")
+        if await self.client.set(key, holder, nx=True, px=int(ttl * 1000)):
+            return True
+        return bool(await self.client.eval(self.renew_lease_script, 1, key,
+                                           holder, int(ttl * 1000)))
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self.client.eval(self.release_lease_script, 1,
+                               self.key(f"lease:{name}"), holder)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def open_state_store() -> StateStore:
+    if STATE_BACKEND not in ("sqlite", "redis"):
+        raise ValueError(f"Unknown state_backend: {STATE_BACKEND}")
+    if STATE_BACKEND == "redis":
+        # Optional dependency, only needed for the shared Redis backend
+        import redis.asyncio
+        return RedisStateStore(redis.asyncio.from_url(REDIS_URL), REDIS_PREFIX)
+    return SQLiteStateStore(STATE_DB_FILE)
+
+
+state_store = open_state_store()
+
+
+# Leader Election
+class LeaderElection:
+    # Holds a renewable lease in the state store; only the holder runs the
+    # scheduled refresh and prefetch jobs.
+
+    def __init__(self, store: StateStore, name: str, holder: str,
+                 lease_ttl: float) -> None:
+        self.store = store
+        self.name = name
+        self.holder = holder
+        self.lease_ttl = lease_ttl
+        self.is_leader = False
+        self.task: Optional[asyncio.Task] = None
+
+    async def renew(self) -> bool:
+        try:
+            is_leader = await self.store.acquire_lease(self.name, self.holder,
+                                                       self.lease_ttl)
+        except Exception as e:
+            # Step down rather than risk two leaders
+            print(f"Leader lease renewal failed: {e!r}")
+            is_leader = False
+        if is_leader != self.is_leader:
+            print(f"Replica {self.holder} is "
+                  f"{'now' if is_leader else 'no longer'} the leader")
+        self.is_leader = is_leader
+        return is_leader
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            await self.renew()
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.is_leader:
+            self.is_leader = False
+            # Lets another replica take over now instead of at expiry
+            try:
+                await self.store.release_lease(self.name, self.holder)
+            except Exception as e:
+                print(f"Leader lease release failed: {e!r}")
+
+
+leader_election = LeaderElection(state_store, "scheduler", REPLICA_ID,
+                                 LEADER_LEASE)
+metrics.gauge("bliss_leader", lambda: int(leader_election.is_leader))
+
+
+# Build Cache
+class BuildCache:
+
+    def __init__(self, ttl: float, negative_ttl: float,
+                 max_entries: int) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # (codename, variant) -> (stored_at, build), least recently used first
+        self.entries: OrderedDict[Tuple[str, str],
+                                  Tuple[float,
+                                        Optional[Build]]] = OrderedDict()
+
+    def get(self, key: Tuple[str,
+                             str]) -> Optional[Tuple[Optional[Build], bool]]:
+        entry = self.entries.get(key)
+        if entry is None:
             return None
-        device_data = json.loads(response.text)['response'][0]
-        build_data = {
-            'date':
-            datetime.datetime.fromtimestamp(
-                device_data['datetime']).strftime('%d-%m-%Y'),
-            'size':
-            humanfriendly.format_size(device_data['size']),
-            'version':
-            device_data['version'],
-            'url':
-            device_data['url'],
-        }
-        return build_data
+        self.entries.move_to_end(key)
+        stored_at, build = entry
+        ttl = self.ttl if build is not None else self.negative_ttl
+        return build, time.time() - stored_at < ttl
+
+    def set(self,
+            key: Tuple[str, str],
+            build: Optional[Build],
+            stored_at: Optional[float] = None) -> None:
+        self.entries[key] = (stored_at or time.time(), build)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, device_codename: Optional[str] = None) -> None:
+        if device_codename is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == device_codename]:
+            del self.entries[key]
+
+
+build_cache = BuildCache(BUILD_CACHE_TTL, BUILD_CACHE_NEGATIVE_TTL,
+                         BUILD_CACHE_MAX_ENTRIES)
+build_refreshes: Set[Tuple[str, str]] = set()
+metrics.gauge("bliss_build_cache_entries", lambda: len(build_cache.entries))
+metrics.gauge("bliss_event_loop_lag_last_seconds", lambda: event_loop_lag)
+background_tasks: Set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine) -> asyncio.Task:
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 
+async def drain_background_tasks(timeout: float) -> None:
+    # Lets in-flight refreshes and writes finish before the pools close
+    if not background_tasks:
+        return
+    _, pending = await asyncio.wait(set(background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"Cancelled {len(pending)} background tasks on shutdown")
+
+
+# Request Coalescing
+class SingleFlight:
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[..., Awaitable],
+                 *args):
+        # Concurrent callers with the same key share one pending call. The
+        # shared call is shielded so a caller giving up does not cancel it
+        # for everyone else.
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function(*args))
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.calls.pop(key, None)
+                                     if self.calls.get(key) is done else None)
+            future.add_done_callback(self.consume_result)
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def consume_result(future: asyncio.Future) -> None:
+        # Every caller may have given up before the call failed; retrieve
+        # the error so asyncio does not report it as never retrieved.
+        if not future.cancelled():
+            future.exception()
+
+
+build_flights = SingleFlight()
+reply_flights = SingleFlight()
+# Shared by every multi-device /bliss so a few large batches cannot flood
+# the updater API
+batch_lookups = asyncio.Semaphore(BATCH_CONCURRENCY)
+# Rendered batch pages by (chat_id, command message id), for the page buttons
+batch_pages: OrderedDict[Tuple[int, int], List[Tuple[
+    str, Optional[InlineKeyboardMarkup]]]] = OrderedDict()
+
+# Scheduled Jobs
+devices_validators: Dict[str, str] = {}
+
+
+def on_device_catalog_changed(old_catalog: Optional[DeviceCatalog],
+                              new_catalog: DeviceCatalog) -> None:
+    if old_catalog is None:
+        return
+    for device_codename in old_catalog.devices.keys(
+    ) - new_catalog.devices.keys():
+        build_cache.invalidate(device_codename)
+        run_in_background(state_store.delete_builds(device_codename))
+
+
+async def load_device_catalog() -> Optional[DeviceCatalog]:
+    # The copy in the shared state store first, then devices.json
+    stored = await state_store.load_catalog()
+    if stored is None:
+        return await asyncio.to_thread(read_devices_file, DEVICES_FILE)
+    content, etag, last_modified = stored
+    try:
+        catalog = await asyncio.to_thread(DeviceCatalog.from_bytes, content)
+    except (ValueError, TypeError) as e:
+        print(f"Stored device list is invalid, reading {DEVICES_FILE}: {e!r}")
+        return await asyncio.to_thread(read_devices_file, DEVICES_FILE)
+    # The stored validators describe this exact content
+    if etag:
+        devices_validators["etag"] = etag
+    if last_modified:
+        devices_validators["last-modified"] = last_modified
+    return catalog
+
+
+async def sync_catalog_job() -> None:
+    # Followers pick up the catalog the leader downloaded instead of asking
+    # upstream themselves.
+    global device_catalog
+    if leader_election.is_leader:
+        return
+    stored = await state_store.load_catalog()
+    if stored is None or (device_catalog is not None
+                          and device_catalog.content_hash == hashlib.sha256(
+                              stored[0]).hexdigest()):
+        return
+    new_catalog = await load_device_catalog()
+    old_catalog = device_catalog
+    device_catalog = new_catalog
+    on_device_catalog_changed(old_catalog, new_catalog)
+
+
+async def download_devices_job() -> Optional[bool]:
+    # Returns whether the catalog changed, or None if the refresh failed.
+    global device_catalog
+    if device_catalog is None:
+        device_catalog = await load_device_catalog()
+    headers: Dict[str, str] = {}
+    if device_catalog is not None:
+        if "etag" in devices_validators:
+            headers["If-None-Match"] = devices_validators["etag"]
+        if "last-modified" in devices_validators:
+            headers["If-Modified-Since"] = devices_validators["last-modified"]
+    try:
+        response = await upstream_get(DEVICES_URL, "devices", headers=headers)
+    except httpx.HTTPError as e:
+        print(f"Device list download failed: {e!r}")
+        return None
+    if response.status_code == 304:
+        return False
+    if response.status_code != 200:
+        print(f"Request failed with status code: {response.status_code}")
+        return None
+    old_catalog = device_catalog
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    unchanged = old_catalog is not None and old_catalog.content_hash == content_hash
+    if not unchanged:
+        # Parse before taking the validators or touching the file, so a
+        # broken upstream list is never written out or marked as current.
+        try:
+            new_catalog = await asyncio.to_thread(DeviceCatalog.from_bytes,
+                                                  response.content)
+        except (ValueError, TypeError) as e:
+            print(f"Downloaded device list is invalid: {e!r}")
+            return None
+    for validator in ("etag", "last-modified"):
+        if validator in response.headers:
+            devices_validators[validator] = response.headers[validator]
+    # Only a list that parsed is stored, restarts load it before the file
+    await state_store.save_catalog(response.content,
+                                   devices_validators.get("etag"),
+                                   devices_validators.get("last-modified"))
+    if unchanged:
+        return False
+    # Swap the new catalog in with a single assignment
+    await asyncio.to_thread(write_devices_file, DEVICES_FILE, response.content)
+    device_catalog = new_catalog
+    on_device_catalog_changed(old_catalog, new_catalog)
+    return True
+
+
+async def announce_builds(device_codename: str,
+                          device_builds: Dict[str, Optional[Build]],
+                          new_variants: List[str]) -> None:
+    if not ANNOUNCE_BUILDS or not TELEGRAM_GROUP_IDS:
+        return
+    device_text, build_keyboard, _ = get_device_text(
+        device_builds=device_builds,
+        device_data=device_catalog.get(device_codename),
+        device_codename=device_codename,
+        closable=False)
+    labels = ", ".join(variant['label'] for variant in BUILD_VARIANTS
+                       if variant['name'] in new_variants)
+    text = f"<strong>New Bliss ROM build ({labels}) for {html.escape(device_codename)}!</strong>\n\n{device_text}"
+    for group_id in TELEGRAM_GROUP_IDS:
+        try:
+            await send_outbound(group_id,
+                                app.send_message,
+                                chat_id=group_id,
+                                text=text,
+                                parse_mode=enums.ParseMode.HTML,
+                                reply_markup=build_keyboard,
+                                disable_web_page_preview=True)
+        except errors.RPCError as e:
+            print(f"Build announcement failed in chat {group_id}: {e}")
+
+
+async def prefetch_device_builds(
+        device_codename: str, announce: bool, semaphore: asyncio.Semaphore,
+        seen_builds: Dict[Tuple[str, str], Tuple[str, str]]) -> None:
+    lookups = [
+        build_flights.do((device_codename, variant['name']), fetch_build,
+                         device_codename, variant['name'])
+        for variant in BUILD_VARIANTS
+    ]
+    async with semaphore:
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+    device_builds: Dict[str, Optional[Build]] = {}
+    seen_rows: List[Tuple[str, str, str, str]] = []
+    new_variants: List[str] = []
+    for variant, result in zip(BUILD_VARIANTS, results):
+        if isinstance(result, Exception):
+            print(
+                f"Prefetch failed: {device_codename}/{variant['name']}: {result!r}"
+            )
+            continue
+        device_builds[variant['name']] = result
+        if result is None:
+            continue
+        release = (result.version, str(result.timestamp))
+        seen_release = seen_builds.get((device_codename, variant['name']))
+        if seen_release == release:
+            continue
+        seen_rows.append((device_codename, variant['name'], *release))
+        # A variant without a record (first lookup that worked, new device
+        # or variant) is only recorded; rollbacks are not announced either.
+        if seen_release is not None and result.timestamp > int(
+                seen_release[1]):
+            new_variants.append(variant['name'])
+    if seen_rows:
+        await state_store.save_seen_builds(seen_rows)
+    if announce and new_variants:
+        await announce_builds(device_codename, device_builds, new_variants)
+
+
+async def prefetch_builds_job(announce: bool = True) -> None:
+    # Keeps every device's builds warm in the cache and announces releases
+    # that were not seen on the previous run.
+    catalog = await devices_list()
+    if not catalog:
+        return
+    seen_builds = await state_store.load_seen_builds()
+    semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    await asyncio.gather(*[
+        prefetch_device_builds(device_codename, announce, semaphore,
+                               seen_builds)
+        for device_codename in catalog.devices
+    ])
+
+
+async def run_scheduled_job(job: Callable[[], Awaitable],
+                            leader_only: bool = False) -> None:
+    # Tracked like any background task so shutdown waits for it
+    if leader_only and not leader_election.is_leader:
+        return
+    try:
+        await run_in_background(job())
+    except Exception as e:
+        print(f"Scheduled job {job.__name__} failed: {e!r}")
+
+
+scheduler = AsyncIOScheduler()
+
+
+def start_scheduler() -> None:
+    scheduler.add_job(run_scheduled_job,
+                      "interval",
+                      args=[download_devices_job, True],
+                      id="download_devices",
+                      hours=3,
+                      next_run_time=datetime.datetime.now(),
+                      max_instances=1,
+                      coalesce=True,
+                      misfire_grace_time=None)
+    scheduler.add_job(run_scheduled_job,
+                      "interval",
+                      args=[prefetch_builds_job, True],
+                      id="prefetch_builds",
+                      minutes=PREFETCH_INTERVAL,
+                      max_instances=1,
+                      coalesce=True,
+                      misfire_grace_time=None)
+    scheduler.add_job(run_scheduled_job,
+                      "interval",
+                      args=[sync_catalog_job],
+                      id="sync_catalog",
+                      seconds=CATALOG_SYNC_INTERVAL,
+                      max_instances=1,
+                      coalesce=True,
+                      misfire_grace_time=None)
+    scheduler.start()
+
+
+async def warm_up() -> None:
+    # Catalog and builds from the state store (or upstream on a first run),
+    # so the first replies after a restart are served from memory.
+    if await devices_list() is None:
+        print("Device list is not available yet, serving without it")
+    await load_build_cache()
+    # Followers wait for the leader to fill the shared store
+    if build_cache.entries or not leader_election.is_leader:
+        return
+    # Nothing cached at all: prefetch for a bounded time and let the rest
+    # finish in the background. Announcing waits for the scheduled run.
+    prefetch = run_in_background(prefetch_builds_job(announce=False))
+    try:
+        await asyncio.wait_for(asyncio.shield(prefetch),
+                               timeout=WARMUP_DEADLINE)
+    except asyncio.TimeoutError:
+        print(f"Build prefetch still running after {WARMUP_DEADLINE}s")
+
+
+# Helper Functions
+async def devices_list() -> Optional[DeviceCatalog]:
+    global device_catalog
+    if device_catalog is not None:
+        return device_catalog
+    async with device_catalog_lock:
+        if device_catalog is None:
+            device_catalog = await load_device_catalog()
+        if device_catalog is None:
+            await download_devices_job()
+    return device_catalog
+
+
+async def get_build(device_codename: str, variant: str) -> Optional[Build]:
+    download_url = DOWNLOAD_BASE_URL.format(device_codename, variant)
+    response = await upstream_get(download_url, "updater", variant)
+    # An overloaded or failing server is not the same as "no build"
+    if is_retryable(response):
+        response.raise_for_status()
+    if response.status_code != 200:
+        print(f"Request failed with status code: {response.status_code}")
+        return None
+    builds = json.loads(response.text)['response']
+    if not builds:
+        return None
+    return Build.decode(builds[0])
+
+
+async def fetch_build(device_codename: str, variant: str) -> Optional[Build]:
+    # A 4xx or empty answer is a real "no build" and is cached briefly;
+    # timeouts, 5xx and transport errors are raised and never cached.
+    stored = await state_store.load_build(device_codename, variant)
+    if stored is not None:
+        # Another replica may have fetched it already
+        fetched_at, build = stored
+        if time.time() - fetched_at < (BUILD_CACHE_TTL if build is not None
+                                       else BUILD_CACHE_NEGATIVE_TTL):
+            build_cache.set((device_codename, variant), build, fetched_at)
+            return build
+    build = await asyncio.wait_for(get_build(device_codename, variant),
+                                   timeout=VARIANT_TIMEOUT)
+    fetched_at = time.time()
+    build_cache.set((device_codename, variant), build, fetched_at)
+    run_in_background(
+        state_store.save_build(device_codename, variant, fetched_at, build))
+    return build
+
+
+# Failures of a single variant lookup, as opposed to "no build"
+BUILD_LOOKUP_ERRORS: Final[Tuple[type, ...]] = (asyncio.TimeoutError,
+                                                httpx.HTTPError, ValueError,
+                                                KeyError)
+
+
+async def get_last_known_build(device_codename: str,
+                               variant: str) -> Optional[Build]:
+    stored = await state_store.load_build(device_codename, variant)
+    if stored is None or stored[1] is None:
+        return None
+    _, build = stored
+    metrics.inc("bliss_build_last_known_total")
+    return replace(build, stale=True)
+
+
+async def refresh_build(device_codename: str, variant: str) -> Optional[Build]:
+    # A failed lookup falls back to the last build ever seen, marked stale.
+    # Without one the error is raised: the lookup failed, which is not the
+    # same as the device having no builds.
+    try:
+        return await build_flights.do((device_codename, variant), fetch_build,
+                                      device_codename, variant)
+    except BUILD_LOOKUP_ERRORS as e:
+        print(f"Build lookup failed: {device_codename}/{variant}: {e!r}")
+        last_known_build = await get_last_known_build(device_codename, variant)
+        if last_known_build is None:
+            raise
+        return last_known_build
+
+
+async def load_build_cache() -> None:
+    # Builds fetched before a restart are served (and refreshed when stale)
+    # instead of every device starting cold.
+    for device_codename, variant, fetched_at, build in await state_store.load_builds(
+            BUILD_CACHE_MAX_ENTRIES):
+        if (device_codename, variant) not in build_cache.entries:
+            build_cache.set((device_codename, variant), build, fetched_at)
+
+
+async def refresh_build_in_background(device_codename: str,
+                                      variant: str) -> None:
+    key = (device_codename, variant)
+    try:
+        await refresh_build(device_codename, variant)
+    except BUILD_LOOKUP_ERRORS:
+        # Already logged, the cached entry stays until a refresh works
+        pass
+    finally:
+        build_refreshes.discard(key)
+
+
+def start_build_refresh(device_codename: str, variant: str) -> None:
+    key = (device_codename, variant)
+    if key not in build_refreshes:
+        build_refreshes.add(key)
+        run_in_background(refresh_build_in_background(device_codename,
+                                                      variant))
+
+
+def peek_cached_build(device_codename: str,
+                      variant: str) -> Optional[Tuple[Optional[Build], bool]]:
+    # Cache lookup that never waits: a stale entry is returned as is while
+    # one refresh runs in the background. None on a miss.
+    cached = build_cache.get((device_codename, variant))
+    if cached is None:
+        metrics.inc("bliss_build_cache_total", result="miss")
+        return None
+    build, fresh = cached
+    metrics.inc("bliss_build_cache_total", result="hit" if fresh else "stale")
+    if fresh:
+        return cached
+    start_build_refresh(device_codename, variant)
+    if build is not None and is_updater_unreachable(device_codename, variant):
+        return replace(build, stale=True), False
+    return cached
+
+
+def is_updater_unreachable(device_codename: str, variant: str) -> bool:
+    return get_circuit_breaker(
+        DOWNLOAD_BASE_URL.format(device_codename, variant)).is_open()
+
+
+async def get_cached_build(device_codename: str,
+                           variant: str) -> Optional[Build]:
+    cached = peek_cached_build(device_codename, variant)
+    if cached is None:
+        return await refresh_build(device_codename, variant)
+    return cached[0]
+
+
+def get_cached_builds(
+        device_codename: str) -> Tuple[Dict[str, Optional[Build]], List[str]]:
+    # Builds from the cache only, for inline queries: variants not cached
+    # yet are returned as missing and fetched in the background.
+    builds: Dict[str, Optional[Build]] = {}
+    missing_variants: List[str] = []
+    for variant in BUILD_VARIANTS:
+        cached = peek_cached_build(device_codename, variant['name'])
+        if cached is None:
+            start_build_refresh(device_codename, variant['name'])
+            missing_variants.append(variant['name'])
+            builds[variant['name']] = None
+        else:
+            builds[variant['name']] = cached[0]
+    return builds, missing_variants
+
+
+async def get_builds(
+    device_codename: str,
+    deadline: float = BUILDS_DEADLINE
+) -> Tuple[Dict[str, Optional[Build]], List[str]]:
+    # Every variant is looked up at once. Returns the builds and the
+    # variants whose lookup failed or missed the overall deadline; those
+    # are None in the builds but may well exist.
+    tasks: Dict[str, asyncio.Task] = {
+        variant['name']:
+        asyncio.create_task(get_cached_build(device_codename, variant['name']))
+        for variant in BUILD_VARIANTS
+    }
+    _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+    builds: Dict[str, Optional[Build]] = {}
+    failed_variants: List[str] = []
+    for variant_name, task in tasks.items():
+        builds[variant_name] = None
+        if task in pending:
+            print(f"Build lookup timed out: {device_codename}/{variant_name}")
+            failed_variants.append(variant_name)
+        elif task.exception() is not None:
+            print(
+                f"Build lookup failed: {device_codename}/{variant_name}: {task.exception()!r}"
+            )
+            failed_variants.append(variant_name)
+        else:
+            builds[variant_name] = task.result()
+    return builds, failed_variants
+
+
+async def render_device_reply(
+    device_codename: str, device_data: Optional[Device]
+) -> Tuple[str, Optional[InlineKeyboardMarkup], bool, bool]:
+    # Also returns whether a lookup failed, so "no builds" is only claimed
+    # when every variant actually answered.
+    device_builds, failed_variants = await get_builds(
+        device_codename=device_codename)
+    device_text, build_keyboard, build_found = get_device_text(
+        device_builds=device_builds,
+        device_data=device_data,
+        device_codename=device_codename)
+    return device_text, build_keyboard, build_found, bool(failed_variants)
+
+
+def resolve_device_terms(catalog: DeviceCatalog,
+                         terms: List[str]) -> Tuple[List[str], List[str]]:
+    # Each term is a codename or, failing that, a brand; keep first-seen order
+    device_codenames: Dict[str, None] = {}
+    unknown_terms: List[str] = []
+    for term in terms:
+        device_codename = catalog.resolve(term)
+        brand_codenames = [device_codename
+                           ] if device_codename else catalog.by_brand(term)
+        if not brand_codenames:
+            unknown_terms.append(term)
+        for brand_codename in brand_codenames:
+            device_codenames[brand_codename] = None
+    return list(device_codenames), unknown_terms
+
+
+async def render_batch_device(
+        catalog: DeviceCatalog,
+        device_codename: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    async with batch_lookups:
+        device_builds, failed_variants = await get_builds(
+            device_codename=device_codename)
+    device_text, build_keyboard, build_found = get_device_text(
+        device_builds=device_builds,
+        device_data=catalog.get(device_codename),
+        device_codename=device_codename,
+        closable=False)
+    if not build_found:
+        device_text += get_missing_builds_text(bool(failed_variants))
+    return f"<strong>{html.escape(device_codename)}</strong>\n{device_text}", build_keyboard
+
+
+async def render_batch_reply(
+    catalog: DeviceCatalog, device_codenames: List[str]
+) -> List[Tuple[str, Optional[InlineKeyboardMarkup]]]:
+    device_replies = await asyncio.gather(
+        *(render_batch_device(catalog, device_codename)
+          for device_codename in device_codenames))
+    # Pack whole devices into pages, with each page's download buttons
+    pages: List[Tuple[List[str], List[List[InlineKeyboardButton]]]] = []
+    page_texts: List[str] = []
+    page_buttons: List[List[InlineKeyboardButton]] = []
+    page_length = 0
+    for device_text, build_keyboard in device_replies:
+        if page_texts and page_length + len(
+                device_text) >= LIST_PAGE_MAX_LENGTH:
+            pages.append((page_texts, page_buttons))
+            page_texts, page_buttons, page_length = [], [], 0
+        page_texts.append(device_text)
+        page_length += len(device_text) + 2
+        if build_keyboard:
+            page_buttons.extend(build_keyboard.inline_keyboard)
+    if page_texts:
+        pages.append((page_texts, page_buttons))
+    return [("\n\n".join(page_texts),
+             InlineKeyboardMarkup(page_buttons) if page_buttons else None)
+            for page_texts, page_buttons in pages]
+
+
+# Outbound Messages
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # Waiters are served in arrival order so messages stay in sequence
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def try_acquire(self) -> bool:
+        now = self.refill()
+        if now < self.blocked_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while not self.try_acquire():
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                else:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity and time.monotonic(
+        ) >= self.blocked_until
+
+
+class OutboundScheduler:
+
+    def __init__(self, chat_rate: float, chat_burst: int, global_rate: float,
+                 global_burst: int, flood_retries: int,
+                 max_flood_wait: float) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.flood_retries = flood_retries
+        self.max_flood_wait = max_flood_wait
+        self.flights = SingleFlight()
+        self.depth = 0
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 4096:
+                for idle_chat_id in [
+                        idle_chat_id for idle_chat_id, idle_bucket in
+                        self.chat_buckets.items() if idle_bucket.is_idle()
+                ]:
+                    del self.chat_buckets[idle_chat_id]
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send(self,
+                   chat_id: int,
+                   function: Callable[[], Awaitable],
+                   dedup_key: Optional[Hashable] = None):
+        # Identical calls queued for the same chat are sent once and every
+        # caller gets the same result.
+        if dedup_key is not None:
+            return await self.flights.do((chat_id, dedup_key), self.dispatch,
+                                         chat_id, function)
+        return await self.dispatch(chat_id, function)
+
+    async def dispatch(self, chat_id: int, function: Callable[[], Awaitable]):
+        chat_bucket = self.chat_bucket(chat_id)
+        self.depth += 1
+        try:
+            for attempt in range(self.flood_retries + 1):
+                await chat_bucket.acquire()
+                await self.global_bucket.acquire()
+                try:
+                    return await function()
+                except (errors.FloodWait, errors.SlowmodeWait) as e:
+                    wait = float(e.value) + random.uniform(0, 2**attempt)
+                    if attempt == self.flood_retries or wait > self.max_flood_wait:
+                        print(
+                            f"Dropping message to {chat_id} after flood wait of {e.value}s"
+                        )
+                        return None
+                    print(f"Flood wait of {e.value}s in chat {chat_id}")
+                    chat_bucket.block(wait)
+        finally:
+            self.depth -= 1
+
+
+outbound_scheduler = OutboundScheduler(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                                       OUTBOUND_GLOBAL_RATE,
+                                       OUTBOUND_GLOBAL_BURST,
+                                       OUTBOUND_FLOOD_RETRIES,
+                                       OUTBOUND_MAX_FLOOD_WAIT)
+user_command_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+inline_query_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+metrics.gauge("bliss_outbound_queue_depth", lambda: outbound_scheduler.depth)
+
+
+async def send_outbound(chat_id: int,
+                        function: Callable[..., Awaitable],
+                        /,
+                        *args,
+                        dedup_key: Optional[Hashable] = None,
+                        **kwargs):
+    return await outbound_scheduler.send(
+        chat_id, functools.partial(function, *args, **kwargs), dedup_key)
+
+
+def user_allowed(buckets: OrderedDict[int, TokenBucket], user: Optional[User],
+                 rate: float, burst: int) -> bool:
+    # Per-user rate limit, excess requests are silently ignored
+    if user is None:
+        return True
+    bucket = buckets.get(user.id)
+    if bucket is None:
+        bucket = TokenBucket(rate, burst)
+        buckets[user.id] = bucket
+        if len(buckets) > 10000:
+            buckets.popitem(last=False)
+    buckets.move_to_end(user.id)
+    return bucket.try_acquire()
+
+
+def command_allowed(message: Message) -> bool:
+    return user_allowed(user_command_buckets, message.from_user,
+                        USER_COMMAND_RATE, USER_COMMAND_BURST)
+
+
+# Deferred Deletions
+class DeferredDeleter:
+
+    def __init__(self, store: StateStore) -> None:
+        self.store = store
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def schedule(self, chat_id: int, message_ids: List[int],
+                       delay: float) -> None:
+        due_at = time.time() + delay
+        await self.store.add_deletions([(chat_id, message_id, due_at)
+                                        for message_id in message_ids])
+        self.wakeup.set()
+
+    async def flush_due(self, bot: Client) -> Optional[float]:
+        due, next_due_at = await self.store.load_due_deletions(time.time())
+        for chat_id, message_ids in due.items():
+            # Telegram deletes at most 100 messages per call
+            for start in range(0, len(message_ids), 100):
+                batch = message_ids[start:start + 100]
+                try:
+                    await send_outbound(chat_id, bot.delete_messages, chat_id,
+                                        batch)
+                except errors.RPCError as e:
+                    print(f"Deferred deletion failed in chat {chat_id}: {e}")
+                await self.store.remove_deletions(chat_id, batch)
+        return next_due_at
+
+    async def run(self, bot: Client) -> None:
+        while True:
+            self.wakeup.clear()
+            try:
+                next_due_at = await self.flush_due(bot)
+            except Exception as e:
+                # A locked database or a dropped connection must not stop
+                # deletions for the rest of the process
+                print(f"Deferred deletion flush failed: {e!r}")
+                next_due_at = time.time() + 5
+            timeout = None if next_due_at is None else max(
+                next_due_at - time.time(), 0)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Client) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(bot))
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+deferred_deleter = DeferredDeleter(state_store)
 
 # hydrogram Helper Functions
-def get_build_keyboard(vanilla_build_url: str, gapps_build_url: str,
-                       pixelgapps_build_url: str, foss_build_url: str,
-                       device_codename: str) -> Optional[InlineKeyboardMarkup]:
+bot_identity: Optional[User] = None
+# chat_id -> (expires_at, can_delete_messages)
+chat_privileges: Dict[int, Tuple[float, bool]] = {}
+
+
+async def get_bot_identity(bot: Client) -> User:
+    global bot_identity
+    if bot_identity is None:
+        bot_identity = await bot.get_me()
+    return bot_identity
+
+
+async def can_delete_messages(bot: Client, chat_id: int) -> bool:
+    cached = chat_privileges.get(chat_id)
+    if cached is not None and time.monotonic() < cached[0]:
+        return cached[1]
+    me = await get_bot_identity(bot)
+    bot_privileges = (await bot.get_chat_member(chat_id, me.id)).privileges
+    allowed = bool(bot_privileges and bot_privileges.can_delete_messages)
+    chat_privileges[chat_id] = (time.monotonic() + PRIVILEGES_TTL, allowed)
+    return allowed
+
+
+def get_stats_text() -> str:
+    text = "<strong>Bot Stats</strong>\n\n<strong>Commands:</strong>\n"
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if name != "bliss_handler_seconds":
+            continue
+        command = dict(labels)["command"]
+        handler_errors = metrics.counters.get(
+            ("bliss_handler_errors_total", labels), 0)
+        text += f"{command}: {histogram[-2]:.0f} calls, {histogram[-1] / histogram[-2] * 1000:.0f} ms avg, {handler_errors:.0f} errors\n"
+    text += "\n<strong>Upstream:</strong>\n"
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if name != "bliss_upstream_seconds":
+            continue
+        statuses = ", ".join(
+            f"{dict(counter_labels)['status']}: {value:.0f}"
+            for (counter_name,
+                 counter_labels), value in sorted(metrics.counters.items())
+            if counter_name == "bliss_upstream_requests_total" and tuple(
+                label
+                for label in counter_labels if label[0] != "status") == labels)
+        endpoint = "/".join(value for _, value in labels if value)
+        text += f"{endpoint}: {histogram[-2]:.0f} requests, {histogram[-1] / histogram[-2] * 1000:.0f} ms avg ({statuses})\n"
+    open_hosts = [
+        breaker.host for breaker in circuit_breakers.values()
+        if breaker.is_open()
+    ]
+    if open_hosts:
+        text += f"Circuit open: {', '.join(open_hosts)}\n"
+    cache_results = {
+        dict(labels)["result"]: value
+        for (name, labels), value in metrics.counters.items()
+        if name == "bliss_build_cache_total"
+    }
+    cache_lookups = sum(cache_results.values())
+    if cache_lookups:
+        text += f"\n<strong>Build Cache:</strong> {cache_results.get('hit', 0) / cache_lookups:.0%} hits, {cache_results.get('stale', 0):.0f} stale, {cache_results.get('miss', 0):.0f} misses, {len(build_cache.entries)} entries\n"
+    text += f"\n<strong>Event Loop Lag:</strong> {event_loop_lag * 1000:.1f} ms\n<strong>Outbound Queue:</strong> {outbound_scheduler.depth}"
+    return text
+
+
+def get_list_page(catalog: DeviceCatalog,
+                  page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    page_count = len(catalog.list_pages)
+    page = min(max(page, 0), page_count - 1)
+    text = f"<strong>Device List:</strong>\n\n{catalog.list_pages[page]}"
     blank_keyboard = []
-    if vanilla_build_url:
-        blank_keyboard.append([
-            InlineKeyboardButton(
-                text=f"Download Vanilla Build ({device_codename})",
-                url=vanilla_build_url)
-        ])
-    if gapps_build_url:
-        blank_keyboard.append([
-            InlineKeyboardButton(
-                text=f"Download Gapps Build ({device_codename})",
-                url=gapps_build_url)
-        ])
-    if pixelgapps_build_url:
-        blank_keyboard.append([
+    navigation_row = []
+    if page > 0:
+        navigation_row.append(
+            InlineKeyboardButton("« Prev", callback_data=f"list:{page - 1}"))
+    if page < page_count - 1:
+        navigation_row.append(
+            InlineKeyboardButton("Next »", callback_data=f"list:{page + 1}"))
+    if navigation_row:
+        text += f"\n\n<i>Page {page + 1} of {page_count}</i>"
+        blank_keyboard.append(navigation_row)
+    blank_keyboard.append(
+        [InlineKeyboardButton("Close", callback_data="close")])
+    return text, InlineKeyboardMarkup(blank_keyboard)
+
+
+def get_batch_page(pages: List[Tuple[str, Optional[InlineKeyboardMarkup]]],
+                   message_id: int,
+                   page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    page = min(max(page, 0), len(pages) - 1)
+    text, build_keyboard = pages[page]
+    blank_keyboard = list(
+        build_keyboard.inline_keyboard) if build_keyboard else []
+    navigation_row = []
+    if page > 0:
+        navigation_row.append(
             InlineKeyboardButton(
-                text=f"Download Pixel Gapps Build ({device_codename})",
-                url=pixelgapps_build_url)
-        ])
-    if foss_build_url:
-        blank_keyboard.append([
+                "« Prev", callback_data=f"batch:{message_id}:{page - 1}"))
+    if page < len(pages) - 1:
+        navigation_row.append(
             InlineKeyboardButton(
-                text=f"Download FOSS Build ({device_codename})",
-                url=foss_build_url)
-        ])
-    if len(blank_keyboard) > 0:
+                "Next »", callback_data=f"batch:{message_id}:{page + 1}"))
+    if navigation_row:
+        text += f"\n\n<i>Page {page + 1} of {len(pages)}</i>"
+        blank_keyboard.append(navigation_row)
+    blank_keyboard.append(
+        [InlineKeyboardButton("Close", callback_data="close")])
+    return text, InlineKeyboardMarkup(blank_keyboard)
+
+
+def get_build_keyboard(
+        build_urls: Dict[str, Optional[str]],
+        device_codename: str,
+        closable: bool = True) -> Optional[InlineKeyboardMarkup]:
+    blank_keyboard = []
+    for variant in BUILD_VARIANTS:
+        build_url = build_urls.get(variant['name'])
+        if build_url:
+            blank_keyboard.append([
+                InlineKeyboardButton(
+                    text=
+                    f"Download {variant['label']} Build ({device_codename})",
+                    url=build_url)
+            ])
+    if len(blank_keyboard) == 0:
+        return None
+    if closable:
         blank_keyboard.append(
             [InlineKeyboardButton("Close", callback_data="close")])
-    else:
-        return None
 
     build_keyboard = InlineKeyboardMarkup(blank_keyboard)
     return build_keyboard
 
 
 def get_device_text(
-        device_vanilla_build: Optional[Dict[str, str]],
-        device_gapps_build: Optional[Dict[str, str]],
-        device_pixelgapps_build: Optional[Dict[str, str]],
-        device_foss_build: Optional[Dict[str, str]],
-        device_data: Optional[Dict[str, str]], device_codename: str
+        device_builds: Dict[str, Optional[Build]],
+        device_data: Optional[Device],
+        device_codename: str,
+        closable: bool = True
 ) -> Tuple[str, Optional[InlineKeyboardMarkup], bool]:
     build_found = False
+    build_stale = False
+    build_keyboard = None
     if not device_data:
         device_text = ""
     else:
-        device_text = f"<strong>Device:</strong> {device_data.get('brand')} {device_data.get('name')}\n<strong>Maintainer:</strong> {device_data.get('maintainer')}\n<strong>Support:</strong> {device_data.get('support')}\n\n"
-        if device_vanilla_build:
-            build_found = True
-            device_text += f"<strong>Build Type:</strong> Vanilla\n<strong>Build Date:</strong> {device_vanilla_build.get('date')}\n<strong>Build Size:</strong> {device_vanilla_build.get('size')}\n<strong>Build Version:</strong> {device_vanilla_build.get('version')}\n\n"
-        if device_gapps_build:
-            build_found = True
-            device_text += f"<strong>Build Type:</strong> GApps\n<strong>Build Date:</strong> {device_gapps_build.get('date')}\n<strong>Build Size:</strong> {device_gapps_build.get('size')}\n<strong>Build Version:</strong> {device_gapps_build.get('version')}"
-        if device_pixelgapps_build:
+        device_text = f"<strong>Device:</strong> {device_data.brand} {device_data.name}\n<strong>Maintainer:</strong> {device_data.maintainer}\n<strong>Support:</strong> {device_data.support}\n\n"
+        build_texts: List[str] = []
+        build_urls: Dict[str, Optional[str]] = {}
+        for variant in BUILD_VARIANTS:
+            device_build = device_builds.get(variant['name'])
+            if not device_build:
+                continue
             build_found = True
-            device_text += f"<strong>Build Type:</strong> Pixel Gapps\n<strong>Build Date:</strong> {device_pixelgapps_build.get('date')}\n<strong>Build Size:</strong> {device_pixelgapps_build.get('size')}\n<strong>Build Version:</strong> {device_pixelgapps_build.get('version')}\n\n"
-        if device_foss_build:
-            build_found = True
-            device_text += f"<strong>Build Type:</strong> FOSS\n<strong>Build Date:</strong> {device_foss_build.get('date')}\n<strong>Build Size:</strong> {device_foss_build.get('size')}\n<strong>Build Version:</strong> {device_foss_build.get('version')}\n\n"
-        build_keyboard = get_build_keyboard(
-            device_vanilla_build.get('url')
-            if device_vanilla_build is not None else None,
-            device_gapps_build.get('url')
-            if device_gapps_build is not None else None,
-            device_pixelgapps_build.get('url')
-            if device_pixelgapps_build is not None else None,
-            device_foss_build.get('url')
-            if device_foss_build is not None else None, device_codename)
+            build_stale = build_stale or device_build.stale
+            build_texts.append(
+                f"<strong>Build Type:</strong> {variant['label']}\n<strong>Build Date:</strong> {device_build.date_text}\n<strong>Build Size:</strong> {device_build.size_text}\n<strong>Build Version:</strong> {device_build.version}"
+            )
+            build_urls[variant['name']] = device_build.url
+        device_text += "\n\n".join(build_texts)
+        if build_stale:
+            device_text += "\n\n<i>The update server is unreachable right now, these are the last known builds.</i>"
+        build_keyboard = get_build_keyboard(build_urls, device_codename,
+                                            closable)
     return device_text, build_keyboard, build_found
 
 
+def get_missing_builds_text(lookup_failed: bool) -> str:
+    if lookup_failed:
+        return "The update server is unreachable right now, please try again later."
+    return "No Bliss ROM builds are available for this device right now."
+
+
 # hydrogram Functions - Commands
 @app.on_message(filters=filters.command("start"))
+@instrument_handler("start")
 async def start_msg(_: Client, message: Message) -> None:
     if message.chat.type in [
             enums.ChatType.SUPERGROUP, enums.ChatType.GROUP
     ] and len(TELEGRAM_GROUP_IDS
               ) > 0 and message.chat.id not in TELEGRAM_GROUP_IDS:
-        await message.reply_text(
-            "Hey there, this bot cannot be used in this group/supergroup!")
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            "Hey there, this bot cannot be used in this group/supergroup!",
+            dedup_key="group-denied")
         return
-    await message.reply_text(
+    await send_outbound(
+        message.chat.id,
+        message.reply_text,
         text=
         "Hey there, I'm Bliss Bot!\n\nUse `/help` to check the list of available commands.\nType `/bliss` {codename} to get BlissROMs for your device.",
         quote=True)
 
 
 @app.on_message(filters=filters.command("help"))
+@instrument_handler("help")
 async def help_msg(_: Client, message: Message) -> None:
     if message.chat.type in [
             enums.ChatType.SUPERGROUP, enums.ChatType.GROUP
     ] and len(TELEGRAM_GROUP_IDS
               ) > 0 and message.chat.id not in TELEGRAM_GROUP_IDS:
-        await message.reply_text(
-            "Hey there, this bot cannot be used in this group/supergroup!")
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            "Hey there, this bot cannot be used in this group/supergroup!",
+            dedup_key="group-denied")
         return
-    await message.reply_text(
+    await send_outbound(
+        message.chat.id,
+        message.reply_text,
         text=
-        "Available commands:\n\n`/bliss` {codename}: Check latest version available for your device.\n`/list`: Check the current list of officially supported devices.",
+        "Available commands:\n\n`/bliss` {codename}: Check latest version available for your device. Pass several codenames or a brand to check them at once.\n`/list`: Check the current list of officially supported devices.",
         quote=True)
 
 
 @app.on_message(filters=filters.command("refresh"))
+@instrument_handler("refresh")
 async def refresh_msg(_: Client, message: Message) -> None:
     if message.from_user.id not in AUTHORIZED_IDS:
-        await message.reply_text(
-            text="You are not authorized to use this command!", quote=True)
+        await send_outbound(message.chat.id,
+                            message.reply_text,
+                            text="You are not authorized to use this command!",
+                            quote=True)
         return
-    asyncio.gather(
-        download_devices_job(),
-        message.reply_text(text="Refreshed devices successfully!", quote=True),
-    )
+    changed = await download_devices_job()
+    if changed is None:
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            text="Sorry, the device list could not be refreshed!",
+            quote=True)
+    elif changed:
+        await send_outbound(message.chat.id,
+                            message.reply_text,
+                            text="Refreshed devices successfully!",
+                            quote=True)
+    else:
+        await send_outbound(message.chat.id,
+                            message.reply_text,
+                            text="Devices are already up to date!",
+                            quote=True)
+
+
+@app.on_message(filters=filters.command("stats"))
+@instrument_handler("stats")
+async def stats_msg(_: Client, message: Message) -> None:
+    if message.from_user.id not in AUTHORIZED_IDS:
+        await send_outbound(message.chat.id,
+                            message.reply_text,
+                            text="You are not authorized to use this command!",
+                            quote=True)
+        return
+    await send_outbound(message.chat.id,
+                        message.reply_text,
+                        text=get_stats_text(),
+                        parse_mode=enums.ParseMode.HTML,
+                        quote=True)
 
 
 @app.on_message(filters=filters.command("list"))
+@instrument_handler("list")
 async def list_msg(_: Client, message: Message) -> None:
     if message.chat.type in [
             enums.ChatType.SUPERGROUP, enums.ChatType.GROUP
     ] and len(TELEGRAM_GROUP_IDS
               ) > 0 and message.chat.id not in TELEGRAM_GROUP_IDS:
-        await message.reply_text(
-            "Hey there, this bot cannot be used in this group/supergroup!")
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            "Hey there, this bot cannot be used in this group/supergroup!",
+            dedup_key="group-denied")
+        return
+    if not command_allowed(message):
         return
     devices_list_full = await devices_list()
-    list_message = await message.reply_text(
-        text="Please wait, loading the device list...", quote=True)
-    text: str = "<strong>Device List:</strong>\n\n"
-    if devices_list_full:
-        for device, device_data in devices_list_full.items():
-            text += f"{html.escape(device_data.get('brand'))} {html.escape(device_data.get('name'))} (<code>{html.escape(device)}</code>)\n"
-        await list_message.edit_text(
-            text=text,
-            parse_mode=enums.ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("Close", callback_data="close")]]))
-        if message.chat.type in [
+    if devices_list_full and devices_list_full.list_pages:
+        text, list_keyboard = get_list_page(devices_list_full, 0)
+        list_message = await send_outbound(message.chat.id,
+                                           message.reply_text,
+                                           text=text,
+                                           parse_mode=enums.ParseMode.HTML,
+                                           reply_markup=list_keyboard,
+                                           quote=True)
+        if list_message is not None and message.chat.type in [
                 enums.ChatType.GROUP, enums.ChatType.SUPERGROUP
         ]:
-            await asyncio.sleep(10)
-            await list_message.delete()
-            bot_privileges = (await
-                              _.get_chat_member(message.chat.id,
-                                                (await
-                                                 _.get_me()).id)).privileges
-            if bot_privileges and bot_privileges.can_delete_messages:
-                await message.delete()
+            message_ids = [list_message.id]
+            if await can_delete_messages(_, message.chat.id):
+                message_ids.append(message.id)
+            await deferred_deleter.schedule(message.chat.id, message_ids,
+                                            LIST_DELETE_DELAY)
     else:
-        await list_message.edit_text(
-            text="Sorry, the device list could not be fetched!")
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            text="Sorry, the device list could not be fetched!",
+            quote=True)
+
+
+def get_not_found_note(unknown_terms: List[str]) -> str:
+    # Kept short, a batch reply's first page is already near the limit
+    return f"<i>Not found: {html.escape(', '.join(unknown_terms[:5]))}</i>"
+
+
+async def send_batch_reply(bot: Client, message: Message,
+                           catalog: DeviceCatalog, device_codenames: List[str],
+                           unknown_terms: List[str]) -> None:
+    notes: List[str] = []
+    if unknown_terms:
+        notes.append(get_not_found_note(unknown_terms))
+    if len(device_codenames) > BATCH_MAX_DEVICES:
+        notes.append(
+            f"<i>Showing the first {BATCH_MAX_DEVICES} of {len(device_codenames)} devices</i>"
+        )
+        device_codenames = device_codenames[:BATCH_MAX_DEVICES]
+    await send_outbound(message.chat.id,
+                        bot.send_chat_action,
+                        chat_id=message.chat.id,
+                        action=enums.ChatAction.TYPING,
+                        dedup_key="typing")
+    pages = await render_batch_reply(catalog, device_codenames)
+    if notes:
+        text, build_keyboard = pages[0]
+        pages[0] = ("\n".join(notes) + "\n\n" + text, build_keyboard)
+    batch_pages[(message.chat.id, message.id)] = pages
+    while len(batch_pages) > BATCH_CACHE_ENTRIES:
+        batch_pages.popitem(last=False)
+    text, batch_keyboard = get_batch_page(pages, message.id, 0)
+    await send_outbound(message.chat.id,
+                        message.reply_text,
+                        text=text,
+                        reply_markup=batch_keyboard,
+                        parse_mode=enums.ParseMode.HTML,
+                        quote=True,
+                        disable_web_page_preview=True)
 
 
 @app.on_message(filters=filters.command("bliss"))
+@instrument_handler("bliss")
 async def bliss_msg(_: Client, message: Message) -> None:
     if message.chat.type in [
             enums.ChatType.SUPERGROUP, enums.ChatType.GROUP
     ] and len(TELEGRAM_GROUP_IDS
               ) > 0 and message.chat.id not in TELEGRAM_GROUP_IDS:
-        await message.reply_text(
-            "Hey there, this bot cannot be used in this group/supergroup!")
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
+            "Hey there, this bot cannot be used in this group/supergroup!",
+            dedup_key="group-denied")
+        return
+    if not command_allowed(message):
         return
     if len(message.text.split()) < 2 and not message.reply_to_message:
-        await message.reply_text(
+        await send_outbound(
+            message.chat.id,
+            message.reply_text,
             text=
             "Please mention the device codename after `/bliss`. Eg: `/bliss Z01R`",
             quote=True)
@@ -413,96 +2470,222 @@ async def bliss_msg(_: Client, message: Message) -> None:
     else:
         devices_list_full = await devices_list()
         if devices_list_full:
-            device_codename = message.text.split()[1]
-            device_list_full_lower = {
-                device.lower(): device
-                for device in devices_list_full
-            }
-            if device_codename.lower() not in device_list_full_lower.keys():
-                await message.reply_text(
+            device_codenames, unknown_terms = resolve_device_terms(
+                devices_list_full,
+                message.text.split()[1:])
+            if len(device_codenames) > 1:
+                await send_batch_reply(_, message, devices_list_full,
+                                       device_codenames, unknown_terms)
+                return
+            device_codename = device_codenames[0] if device_codenames else None
+            if device_codename is None:
+                await send_outbound(
+                    message.chat.id,
+                    message.reply_text,
                     text=
                     "Bliss ROM for the specified device does not exist!\nUse `/list` to check the supported device list",
                     quote=True)
             else:
-                await _.send_chat_action(chat_id=message.chat.id,
-                                         action=enums.ChatAction.TYPING)
-                device_codename = device_list_full_lower.get(
-                    device_codename.lower())
-                device_gapps_build = await get_gapps_build(
-                    device_codename=device_codename)
-                device_vanilla_build = await get_vanilla_build(
-                    device_codename=device_codename)
-                device_data = await get_device_info(
-                    device_codename=device_codename)
-                device_pixelgapps_build = await get_pixelgapps_build(
-                    device_codename=device_codename)
-                device_foss_build = await get_foss_build(
-                    device_codename=device_codename)
-                device_text, build_keyboard, build_found = get_device_text(
-                    device_vanilla_build=device_vanilla_build,
-                    device_gapps_build=device_gapps_build,
-                    device_pixelgapps_build=device_pixelgapps_build,
-                    device_foss_build=device_foss_build,
-                    device_data=device_data,
-                    device_codename=device_codename)
-                if not build_found:
-                    await message.reply_text(
+                await send_outbound(message.chat.id,
+                                    _.send_chat_action,
+                                    chat_id=message.chat.id,
+                                    action=enums.ChatAction.TYPING,
+                                    dedup_key="typing")
+                device_text, build_keyboard, build_found, lookup_failed = await reply_flights.do(
+                    device_codename, render_device_reply, device_codename,
+                    devices_list_full.get(device_codename))
+                if not build_found and lookup_failed:
+                    await send_outbound(message.chat.id,
+                                        message.reply_text,
+                                        text=get_missing_builds_text(True),
+                                        quote=True,
+                                        dedup_key=("bliss", device_codename,
+                                                   "unreachable"))
+                elif not build_found:
+                    await send_outbound(
+                        message.chat.id,
+                        message.reply_text,
                         text=
                         "Bliss ROM for the specified device does not exist!\nUse `/list` to check the supported device list",
                         quote=True)
                 else:
-                    await message.reply_text(text=device_text,
-                                             reply_markup=build_keyboard,
-                                             parse_mode=enums.ParseMode.HTML,
-                                             quote=True,
-                                             disable_web_page_preview=True)
+                    if unknown_terms:
+                        device_text = f"{get_not_found_note(unknown_terms)}\n\n{device_text}"
+                    await send_outbound(message.chat.id,
+                                        message.reply_text,
+                                        text=device_text,
+                                        reply_markup=build_keyboard,
+                                        parse_mode=enums.ParseMode.HTML,
+                                        quote=True,
+                                        disable_web_page_preview=True,
+                                        dedup_key=("bliss", device_codename,
+                                                   *unknown_terms))
         else:
-            await message.reply_text(
+            await send_outbound(
+                message.chat.id,
+                message.reply_text,
                 text="Sorry, the device list could not be fetched!",
                 quote=False)
 
 
+# hydrogram Functions - Inline Queries
+def get_inline_result(
+        device_codename: str,
+        device_data: Device) -> Tuple[InlineQueryResultArticle, bool]:
+    # Also returns whether the result is complete; one still waiting on
+    # build data must not be cached by Telegram.
+    device_builds, missing_variants = get_cached_builds(device_codename)
+    device_text, build_keyboard, build_found = get_device_text(
+        device_builds=device_builds,
+        device_data=device_data,
+        device_codename=device_codename,
+        closable=False)
+    if not build_found:
+        if missing_variants and not is_updater_unreachable(
+                device_codename, missing_variants[0]):
+            device_text += "Looking up builds for this device, search again in a moment."
+        else:
+            device_text += get_missing_builds_text(bool(missing_variants))
+    return InlineQueryResultArticle(
+        id=device_codename,
+        title=f"{device_data.brand} {device_data.name}",
+        description=f"{device_codename} • Maintainer: {device_data.maintainer}",
+        input_message_content=InputTextMessageContent(
+            message_text=device_text,
+            parse_mode=enums.ParseMode.HTML,
+            disable_web_page_preview=True),
+        reply_markup=build_keyboard), not missing_variants
+
+
+@app.on_inline_query()
+@instrument_handler("inline_query")
+async def inline_query_msg(_: Client, query: InlineQuery) -> None:
+    # Answered from memory on every keystroke, never waiting on the updater
+    if not user_allowed(inline_query_buckets, query.from_user,
+                        INLINE_QUERY_RATE, INLINE_QUERY_BURST):
+        return
+    devices_list_full = await devices_list()
+    if not devices_list_full:
+        await query.answer(results=[], cache_time=INLINE_CACHE_TIME)
+        return
+    device_codenames = devices_list_full.search(query.query,
+                                                INLINE_RESULTS_LIMIT)
+    results: List[InlineQueryResultArticle] = []
+    complete = True
+    for device_codename in device_codenames:
+        result, result_complete = get_inline_result(
+            device_codename, devices_list_full.devices[device_codename])
+        results.append(result)
+        complete = complete and result_complete
+    await query.answer(results=results,
+                       cache_time=INLINE_CACHE_TIME if complete else 0)
+
+
+# hydrogram Functions - Chat Member Updates
+@app.on_chat_member_updated()
+async def bot_member_updated(_: Client, update: ChatMemberUpdated) -> None:
+    member = update.new_chat_member or update.old_chat_member
+    if bot_identity is None or member is None or member.user is None:
+        return
+    if member.user.id == bot_identity.id:
+        chat_privileges.pop(update.chat.id, None)
+
+
 # hydrogram Functions - Callback Queries
 @app.on_callback_query(filters=filters.regex("close"))
+@instrument_handler("close")
 async def close_msg(bot: Client, query: CallbackQuery) -> None:
     if query.message.chat.type == enums.ChatType.PRIVATE:
-        await query.message.reply_to_message.delete()
+        await send_outbound(query.message.chat.id,
+                            query.message.reply_to_message.delete)
     elif query.message.chat.type in [
             enums.ChatType.GROUP, enums.ChatType.SUPERGROUP
     ]:
-        bot_privileges = (await
-                          bot.get_chat_member(query.message.chat.id,
-                                              (await
-                                               bot.get_me()).id)).privileges
-        if bot_privileges and bot_privileges.can_delete_messages:
-            await query.message.reply_to_message.delete()
-    await query.message.delete()
+        if await can_delete_messages(bot, query.message.chat.id):
+            await send_outbound(query.message.chat.id,
+                                query.message.reply_to_message.delete)
+    await send_outbound(query.message.chat.id, query.message.delete)
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-import asyncio
-import datetime
 
-scheduler = AsyncIOScheduler()
+@app.on_callback_query(filters=filters.regex(r"^list:(\d+)$"))
+@instrument_handler("list_page")
+async def list_page_msg(_: Client, query: CallbackQuery) -> None:
+    devices_list_full = await devices_list()
+    if not devices_list_full or not devices_list_full.list_pages:
+        await query.answer("Sorry, the device list could not be fetched!")
+        return
+    text, list_keyboard = get_list_page(devices_list_full,
+                                        int(query.matches[0].group(1)))
+    await send_outbound(query.message.chat.id,
+                        query.message.edit_text,
+                        text=text,
+                        parse_mode=enums.ParseMode.HTML,
+                        reply_markup=list_keyboard)
+    await query.answer()
 
-@app.on_message(filters.command("start"))
-async def start_msg(_: Client, message: Message) -> None:
-    print(f"Received /start from {message.from_user.id}")  # Debug
-    await message.reply_text("Hey there! Bliss Bot at your service.")
-
-async def start_scheduler():
-    loop = asyncio.get_event_loop()  # Ensures the loop is running
-    scheduler.add_job(
-        func=lambda: loop.create_task(download_devices_job()),
-        trigger="interval",
-        hours=3,
-        next_run_time=datetime.datetime.now(),
-        misfire_grace_time=None
-    )
-    scheduler.start()
-    print("Scheduler started")
 
-if __name__ == "__main__":
-    # Make sure the scheduler starts after the event loop is initialized
-    app.run()  # Start the bot (this will trigger event loop)
-    asyncio.run(start_scheduler())  # Safely start the scheduler after the loop is running
+@app.on_callback_query(filters=filters.regex(r"^batch:(\d+):(\d+)$"))
+@instrument_handler("batch_page")
+async def batch_page_msg(_: Client, query: CallbackQuery) -> None:
+    pages = batch_pages.get(
+        (query.message.chat.id, int(query.matches[0].group(1))))
+    if not pages:
+        await query.answer(
+            "This result has expired, please send the command again!")
+        return
+    text, batch_keyboard = get_batch_page(pages,
+                                          int(query.matches[0].group(1)),
+                                          int(query.matches[0].group(2)))
+    await send_outbound(query.message.chat.id,
+                        query.message.edit_text,
+                        text=text,
+                        parse_mode=enums.ParseMode.HTML,
+                        reply_markup=batch_keyboard,
+                        disable_web_page_preview=True)
+    await query.answer()
+
+
+async def main() -> None:
+    loop_monitor = None
+    metrics_server = None
+    # Everything opened from here on is closed again, even if startup fails
+    try:
+        get_http_client()  # Open the shared connection pool before serving
+        await leader_election.renew()
+        leader_election.start()
+        await warm_up()
+        start_scheduler()
+        await app.start()
+        await get_bot_identity(app)
+        # Also sends deletions left over from before a restart
+        deferred_deleter.start(app)
+        loop_monitor = run_in_background(monitor_event_loop())
+        if METRICS_PORT:
+            metrics_server = await asyncio.start_server(
+                serve_metrics, METRICS_HOST, METRICS_PORT)
+        print("Bliss Bot is up")
+        await idle()
+    finally:
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        if loop_monitor is not None:
+            loop_monitor.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        # Running jobs may still announce, so they finish while the client
+        # is connected
+        await drain_background_tasks(SHUTDOWN_TIMEOUT)
+        await deferred_deleter.stop()
+        if app.is_connected:
+            # Handles the updates already received, then disconnects
+            await app.stop()
+        # Refreshes started by those last updates
+        await drain_background_tasks(SHUTDOWN_TIMEOUT)
+        await leader_election.stop()
+        await close_http_client()
+        await state_store.close()
+
 
+if __name__ == "__main__":
+    app.run(main())
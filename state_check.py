@@ -0,0 +1,270 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import yaml
+
+from benchmark import BENCHMARK_CONFIG, REPO_DIR
+
+# Offline check of the shared state backends. Both StateStore backends run
+# the same scenario: SQLite against a scratch database, and the Redis
+# backend against FakeRedis, an in-process stand-in for the subset of the
+# redis-py asyncio API it uses.
+
+RedisValue = Union[bytes, str, int, float]
+
+
+class FakeRedis:
+    # Values are stored as bytes, the way a redis-py client without
+    # decode_responses returns them.
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Union[bytes, Dict[bytes, bytes],
+                                   Dict[bytes, float]]] = {}
+        self.expires_at: Dict[str, float] = {}
+
+    @staticmethod
+    def encode(value: RedisValue) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value,
+                      (str, int, float)) and not isinstance(value, bool):
+            return str(value).encode()
+        # redis-py raises DataError for anything else
+        raise TypeError(f"Invalid input of type {type(value).__name__}")
+
+    def expire(self, name: str) -> None:
+        if name in self.expires_at and time.monotonic(
+        ) >= self.expires_at[name]:
+            del self.data[name]
+            del self.expires_at[name]
+
+    async def get(self, name: str) -> Optional[bytes]:
+        self.expire(name)
+        return self.data.get(name)
+
+    async def set(self,
+                  name: str,
+                  value: RedisValue,
+                  nx: bool = False,
+                  px: Optional[int] = None) -> Optional[bool]:
+        self.expire(name)
+        if nx and name in self.data:
+            return None
+        self.data[name] = self.encode(value)
+        self.expires_at.pop(name, None)
+        if px is not None:
+            self.expires_at[name] = time.monotonic() + px / 1000
+        return True
+
+    async def delete(self, *names: str) -> int:
+        deleted = 0
+        for name in names:
+            self.expire(name)
+            if self.data.pop(name, None) is not None:
+                deleted += 1
+            self.expires_at.pop(name, None)
+        return deleted
+
+    async def pexpire(self, name: str, milliseconds: int) -> int:
+        self.expire(name)
+        if name not in self.data:
+            return 0
+        self.expires_at[name] = time.monotonic() + int(milliseconds) / 1000
+        return 1
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args:
+                   RedisValue) -> int:
+        # Only the compare-and-act lease scripts of RedisStateStore
+        import bliss
+        key, holder, *args = keys_and_args
+        if await self.get(key) != self.encode(holder):
+            return 0
+        if script == bliss.RedisStateStore.renew_lease_script:
+            return await self.pexpire(key, args[0])
+        if script == bliss.RedisStateStore.release_lease_script:
+            return await self.delete(key)
+        raise NotImplementedError(f"Unknown script: {script}")
+
+    async def hset(
+            self,
+            name: str,
+            key: Optional[RedisValue] = None,
+            value: Optional[RedisValue] = None,
+            mapping: Optional[Dict[RedisValue, RedisValue]] = None) -> int:
+        fields = self.data.setdefault(name, {})
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = 0
+        for field_name, field_value in items.items():
+            field_name = self.encode(field_name)
+            added += field_name not in fields
+            fields[field_name] = self.encode(field_value)
+        return added
+
+    async def hget(self, name: str, key: RedisValue) -> Optional[bytes]:
+        return self.data.get(name, {}).get(self.encode(key))
+
+    async def hgetall(self, name: str) -> Dict[bytes, bytes]:
+        return dict(self.data.get(name, {}))
+
+    async def hkeys(self, name: str) -> List[bytes]:
+        return list(self.data.get(name, {}))
+
+    async def hdel(self, name: str, *keys: RedisValue) -> int:
+        fields = self.data.get(name, {})
+        return sum(
+            fields.pop(self.encode(key), None) is not None for key in keys)
+
+    async def zadd(self, name: str, mapping: Dict[RedisValue, float]) -> int:
+        members = self.data.setdefault(name, {})
+        added = 0
+        for member, score in mapping.items():
+            member = self.encode(member)
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    @staticmethod
+    def score_bound(bound: RedisValue, upper: bool):
+        bound = bound.decode() if isinstance(bound, bytes) else str(bound)
+        exclusive = bound.startswith("(")
+        value = float(bound.lstrip("(").replace("inf", "Infinity"))
+        if upper:
+            return (lambda score: score < value) if exclusive else (
+                lambda score: score <= value)
+        return (lambda score: score > value) if exclusive else (
+            lambda score: score >= value)
+
+    async def zrangebyscore(
+        self,
+        name: str,
+        min: RedisValue,
+        max: RedisValue,
+        start: Optional[int] = None,
+        num: Optional[int] = None,
+        withscores: bool = False
+    ) -> Union[List[bytes], List[Tuple[bytes, float]]]:
+        above_min = self.score_bound(min, upper=False)
+        below_max = self.score_bound(max, upper=True)
+        members = sorted(((member, score)
+                          for member, score in self.data.get(name, {}).items()
+                          if above_min(score) and below_max(score)),
+                         key=lambda entry: (entry[1], entry[0]))
+        if start is not None and num is not None:
+            members = members[start:start + num]
+        if withscores:
+            return members
+        return [member for member, _ in members]
+
+    async def zrem(self, name: str, *values: RedisValue) -> int:
+        members = self.data.get(name, {})
+        return sum(
+            members.pop(self.encode(value), None) is not None
+            for value in values)
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def check_store(bliss, store, name: str) -> None:
+    now = time.time()
+    build = bliss.Build(timestamp=1700000000,
+                        size=1500000000,
+                        version="17.0",
+                        url="https://example.invalid/gapps")
+
+    assert await store.load_catalog() is None
+    await store.save_catalog(b'[{"codename": "a"}]', '"etag"', None)
+    assert await store.load_catalog() == (b'[{"codename": "a"}]', '"etag"',
+                                          None)
+
+    assert await store.load_build("a", "gapps") is None
+    await store.save_build("a", "gapps", now, build)
+    await store.save_build("a", "foss", now - 10, None)
+    await store.save_build("b", "gapps", now - 5, build)
+    assert await store.load_build("a", "gapps") == (now, build)
+    assert await store.load_build("a", "foss") == (now - 10, None)
+    assert [(device_codename, variant)
+            for device_codename, variant, _, _ in await store.load_builds(2)
+            ] == [("a", "gapps"), ("b", "gapps")]
+    await store.delete_builds("a")
+    assert [(device_codename, variant)
+            for device_codename, variant, _, _ in await store.load_builds(10)
+            ] == [("b", "gapps")]
+
+    await store.save_seen_builds([("b", "gapps", "17.0", "1700000000")])
+    assert await store.load_seen_builds() == {
+        ("b", "gapps"): ("17.0", "1700000000")
+    }
+
+    await store.add_deletions([(-100, 1, now - 1), (-100, 2, now - 1),
+                               (-200, 3, now + 60)])
+    due, next_due_at = await store.load_due_deletions(now)
+    assert due == {
+        -100: [1, 2]
+    } and next_due_at == now + 60, (due, next_due_at)
+    await store.remove_deletions(-100, [1, 2])
+    assert await store.load_due_deletions(now) == ({}, now + 60)
+
+    assert await store.acquire_lease("scheduler", "one", 0.2)
+    assert not await store.acquire_lease("scheduler", "two", 0.2)
+    assert await store.acquire_lease("scheduler", "one", 0.2)
+    await asyncio.sleep(0.3)
+    assert await store.acquire_lease("scheduler", "two", 0.2)
+    assert not await store.acquire_lease("scheduler", "one", 0.2)
+    await store.release_lease("scheduler", "one")
+    assert not await store.acquire_lease("scheduler", "one", 0.2)
+    await store.release_lease("scheduler", "two")
+    assert await store.acquire_lease("scheduler", "one", 0.2)
+    await store.release_lease("scheduler", "one")
+    print(f"{name}: ok")
+
+
+async def check_leader_election(bliss, stores: List, name: str) -> None:
+    first, second = (bliss.LeaderElection(store, "scheduler", holder, 1)
+                     for store, holder in zip(stores, ("one", "two")))
+    assert await first.renew() and not await second.renew()
+    await first.stop()
+    assert await second.renew()
+    await second.stop()
+    print(f"{name} leader election: ok")
+
+
+async def run_checks() -> None:
+    import bliss
+    await check_store(bliss, bliss.SQLiteStateStore("check_state.db"),
+                      "sqlite")
+    await check_store(bliss, bliss.RedisStateStore(FakeRedis(), "bliss"),
+                      "redis")
+    sqlite_stores = [
+        bliss.SQLiteStateStore("check_state.db"),
+        bliss.SQLiteStateStore("check_state.db")
+    ]
+    await check_leader_election(bliss, sqlite_stores, "sqlite")
+    redis = FakeRedis()
+    await check_leader_election(bliss, [
+        bliss.RedisStateStore(redis, "bliss"),
+        bliss.RedisStateStore(redis, "bliss")
+    ], "redis")
+    for store in sqlite_stores:
+        await store.close()
+    await bliss.state_store.close()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory(prefix="bliss-state-check-") as work_dir:
+        with open(os.path.join(work_dir, "config.yml"), "w") as f:
+            yaml.safe_dump(BENCHMARK_CONFIG, f)
+        os.chdir(work_dir)
+        sys.path.insert(0, REPO_DIR)
+        asyncio.run(run_checks())
+        os.chdir(REPO_DIR)
+
+
+if __name__ == "__main__":
+    main()